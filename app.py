@@ -1,98 +1,129 @@
+import eventlet
+eventlet.monkey_patch()  # make requests/pymongo sockets cooperative so scrapes can run concurrently
+
 from bson import ObjectId
-from flask import Flask, request, redirect, url_for, render_template, jsonify, send_from_directory
+from bson.errors import InvalidId
+from flask import (Blueprint, Flask, Response, current_app, request, redirect, url_for, render_template, jsonify,
+                   send_from_directory)
 from werkzeug.utils import secure_filename
-from flask_sqlalchemy import SQLAlchemy
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
-import requests
-from requests.adapters import HTTPAdapter
 import pymongo
-from pymongo.errors import ConnectionFailure
-from requests.packages.urllib3.util.retry import Retry # type: ignore
-from upload_shopify import upload_product_to_shopify
-from bs4 import BeautifulSoup
-
-import time
-import re
+from pymongo.errors import ConnectionFailure, PyMongoError
+from shopify_sync import SYNC_FAILED, sync_product
+from upload_shopify import shopify_status
+from cache import read_cache
+from change_feed import CHANGE_FEED, catalog_room, run_change_feed
+from storage import client, products_collection, ensure_product_indexes, product_filter, GRID_PROJECTION
+from scraper import ensure_validator_index
+from shopify_index import ensure_shopify_index_indexes
+from images import (IMAGE_MAX_BYTES, IMAGE_STORE, ImageTooLarge, ensure_image_indexes, image_url, images_collection,
+                    is_content_addressed, store_image, variant_filename)
+from logs import configure_logging
+from metrics import render as render_metrics
+from progress import job_room
+from jobs import (SOCKETIO_MESSAGE_QUEUE, jobs_collection, enqueue_scrape, ensure_job_indexes,
+                  public_job, run_worker)
+
+import logging
 import os
 import shopify
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 import json
 
-app = Flask(__name__)
-
 load_dotenv()
 
-mongo_uri = os.environ.get('MONGODB_URI')
-# MongoDB Configuration
-try:
-    # client = pymongo.MongoClient('mongodb://localhost:27017/', serverSelectionTimeoutMS=5000)
-    client = pymongo.MongoClient('mongo_uri')
-
-    # The serverSelectionTimeoutMS option limits the amount of time the connection attempt will wait for a response
-    db = client['admin']  # Database name
-    collectionA = db['adidas']  # Collection name
-    collectionB = db['nike']
-    collectionC = db['jordan']
-    # Check if the server is available
-    client.admin.command('ping')
-    print("MongoDB connection successful!")    
-    
-except ConnectionFailure as e:
-    print(f"MongoDB connection failed: {e}")
-CORS(app)  # Allow cross-origin requests
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
-time.sleep(4)
+logger = logging.getLogger(__name__)
+bp = Blueprint('main', __name__)
+socketio = SocketIO()
 
+# Scrape jobs normally run in the worker process; a non-zero value also runs
+# them inside the web process (handy for `python app.py` during development)
+EMBEDDED_WORKERS = int(os.environ.get('EMBEDDED_WORKERS', 0))
+# Seconds between attempts to create the indexes while Mongo is unreachable
+INDEX_RETRY_INTERVAL = float(os.environ.get('INDEX_RETRY_INTERVAL', 30))
+# Seconds each dependency check behind /readyz may take
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', 2))
 
 # When user click scraped product's image, user can change product image
-UPLOAD_FOLDER = 'static/uploads/'  # Folder where uploaded images are saved
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+UPLOAD_FOLDER = IMAGE_STORE  # Folder where uploaded images are saved, named by content hash
+# Cache lifetime of stored images (a year: their names change with their content)
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def ensure_indexes():
+    """Create the collections' indexes once Mongo can be reached."""
+    while True:
+        try:
+            ensure_validator_index()
+            ensure_product_indexes()
+            ensure_job_indexes()
+            ensure_shopify_index_indexes()
+            ensure_image_indexes()
+            logger.info('MongoDB indexes are in place')
+            return
+        except ConnectionFailure as e:
+            logger.warning('MongoDB not reachable yet, retrying index creation in %ss: %s', INDEX_RETRY_INTERVAL, e)
+            eventlet.sleep(INDEX_RETRY_INTERVAL)
+        except PyMongoError as e:
+            # Rejected by the server (a conflicting index, missing privileges): retrying will not help
+            logger.error('Could not create the MongoDB indexes: %s', e)
+            return
+
+
+def create_app():
+    """Build the app. Nothing here waits on Mongo or Shopify: their clients
+    connect on first use, and /readyz reports whether they can be reached."""
+    configure_logging()
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MAX_CONTENT_LENGTH'] = IMAGE_MAX_BYTES
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+    CORS(app)  # Allow cross-origin requests
+    app.register_blueprint(bp)
+    socketio.init_app(app, cors_allowed_origins="*", async_mode='eventlet', message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+    socketio.start_background_task(ensure_indexes)
+    if CHANGE_FEED:
+        # Product changes from any process reach the clients watching the brand
+        socketio.start_background_task(run_change_feed, socketio.emit, read_cache.invalidate)
+    if EMBEDDED_WORKERS:
+        socketio.start_background_task(run_worker, EMBEDDED_WORKERS, socketio.emit, read_cache.invalidate)
+    return app
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
 
 @socketio.on('connect')
 def handle_connect():
-    print('Client connected')
+    logger.debug('Client connected')
     emit('message', {'message': 'Welcome to the chat!'}, broadcast=True)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print('Client disconnected')
+    logger.debug('Client disconnected')
 
 @socketio.on('message')
 def handle_message(data):
-    print(f'Message received: {data}')
+    logger.debug('Message received: %s', data)
     emit('message', {'message': data}, broadcast=True)
 
-# Configure retries and timeout
-def requests_retry_session(
-    retries=3,
-    backoff_factor=0.3,
-    status_forcelist=(500, 502, 504),
-    session=None,
-):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-headers = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-}
-
-@app.route('/uploads/<filename>')
+@bp.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-@app.route('/upload-image', methods=['POST'])
+    # ?w=400 serves the smallest resized copy at least that wide, once it exists
+    width = request.args.get('w', type=int)
+    if width:
+        image = images_collection.find_one({'filename': filename})
+        if image:
+            filename = variant_filename(image, width)
+    if not is_content_addressed(filename):
+        return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    # Named by their content hash, so a URL never changes what it serves
+    response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+@bp.route('/upload-image', methods=['POST'])
 def upload_image():
     if 'image' not in request.files:
         return jsonify({"success": False, "message": "No file part"})
@@ -102,173 +133,15 @@ def upload_image():
         return jsonify({"success": False, "message": "No selected file"})
 
     if file:
-        filename = file.filename
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-
-        image_url = f"/{UPLOAD_FOLDER}/{filename}"  # Assuming you serve static files from this folder
-        return jsonify({"success": True, "imageUrl": image_url})
+        # Stored under the hash of its content: the same image uploaded twice is kept once
+        try:
+            image = store_image(file.stream, file.filename)
+        except ImageTooLarge as e:
+            return jsonify({"success": False, "message": str(e)}), 413
+        return jsonify({"success": True, "imageUrl": image_url(image['filename'])})
 
     return jsonify({"success": False, "message": "Upload failed"})
 
-# Function to scrape product data from USG Store
-def scrape_product(url, brand):
-    session = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
-
-    # Initialize an empty product dictionary to avoid UnboundLocalError
-    product = {}
-    variants = []  # To store variants/sub-products
-
-    try:
-        response = session.get(url)
-        response.raise_for_status()  # Raise an error for invalid responses
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # Scraping product details
-        product['Title'] = soup.find('h3').get_text(strip=True)  # Assuming h3 is for product title
-        product['Brand'] = brand  
-        product['Color'] = soup.find('h4').get_text(strip=True)  # Assuming color is in h4
-        
-        product['Material'] = 'Leather'
-        product['Age group'] = 'Adult'
-        
-        price_meta_tag = soup.find('meta', property='og:price:amount')
-        if price_meta_tag:
-            product['price'] = price_meta_tag.get('content')
-            print(f"Price: {product['price']}")
-        else:
-            product['price'] = 'Price not found'
-            print('Price meta tag not found')
-        # Check if there is embedded JavaScript containing product data
-        script_tag = soup.find('script', text=re.compile('new Shopify\\.OptionSelectors'))
-        
-        if script_tag:
-            # Extract the text of the script tag
-            script_content = script_tag.string
-
-            # Use regex to find specific product fields like 'SKU', 'Size', etc.
-            size_match = re.search(r'"Size":"(.*?)"', script_content)
-            sku_match = re.search(r'"sku":"(.*?)"', script_content)
-            barcode_match = re.search(r'"barcode":"(.*?)"', script_content)
-            weight_match = re.search(r'"weight":(\d+)', script_content)
-            quantity_match = re.search(r'"inventory_quantity":(\d+)', script_content)
-            id_match = re.search(r'"id":(\d+)', script_content)
-            gender_match = re.search(r'"type":"(.*?)"', script_content)
-
-            # Extract and store the found values
-            product['Size'] = size_match.group(1) if size_match else 'Size not found'
-            product['SKU'] = sku_match.group(1) if sku_match else 'SKU not found'
-            product['Barcode'] = barcode_match.group(1) if barcode_match else 'Barcode not found'
-            product['Weight'] = weight_match.group(1) if weight_match else 'Weight not found'
-            product['Quantity'] = quantity_match.group(1) if quantity_match else 'Quantity not found'
-            product['id'] = id_match.group(1) if id_match else 'ID not found'
-            product['Gender'] = gender_match.group(1) if gender_match else 'gender not found'
-
-            # Add variants logic
-            product_data_match = re.search(r'product:\s*(\{.*\})', script_content)
-            if product_data_match:
-                product_data_json = product_data_match.group(1)
-                product_data = json.loads(product_data_json)
-
-                # Add the original product details
-                product['id'] = product_data.get('id', 'ID not found')
-                
-                # Loop through each variant to extract its specific details
-                for variant in product_data['variants']:
-                    variant_data = {
-
-                        'Size': variant.get('option2', 'Size not found'),
-                        'ID': variant.get('id', 'ID not found'),
-                        'SKU': variant.get('sku', 'SKU not found'),
-                        'Barcode': variant.get('barcode', 'Barcode not found'),
-                        'Quantity': variant.get('inventory_quantity', 'Quantity not found'),
-                        'Weight': variant.get('weight', 'Weight not found')
-                        
-                    }
-                    variants.append(variant_data)
-
-        else:
-            print('No JavaScript object found containing product details')
-
-        # Add variants to the main product dictionary
-        product['Variants'] = variants
-
-        details_div = soup.find('div', class_='product-details-tabs-description-flex-col')
-
-        if details_div:
-            # Find the <ul> tag within the div
-            ul_tag = details_div.find('ul')
-            
-            if ul_tag:
-                # Extract text from all <li> tags inside the <ul>
-                list_items = [li.get_text(strip=True) for li in ul_tag.find_all('li')]
-                
-                # Combine list items with proper formatting
-                product_details = "\n".join(list_items)
-
-                # Replace 'USG' with 'GOOD LOOKS'
-                product_details = product_details.replace('USG', 'GOOD LOOKS')
-
-                # Store and print the product details
-                product['product_detail'] = product_details
-                print(f"Product details:\n{product['product_detail']}")
-            else:
-                product = {'product_detail': 'No list found'}
-                print('No list found in product details')
-        else:
-            product = {'product_detail': 'Details not found'}
-            print('No product details found')
-
-        # Find the main div containing the thumbnail images
-        # Find the main div containing the thumbnail images1
-        thumbnail_slider = soup.find('div', class_='product-image-slider')
-
-        if thumbnail_slider:
-            # Get the div with class 'slick-track' that contains the images
-
-            # Initialize a list to store all image URLs
-            images = []
-
-            # Loop through all the img tags within the slick-track div
-            for img_tag in thumbnail_slider.find_all('img'):
-                if img_tag and 'src' in img_tag.attrs:
-                    img_src = img_tag['src']
-
-                    # If the src starts with '//', add the https: prefix
-                    if img_src.startswith('//'):
-                        img_src = 'https:' + img_src
-
-                    # Append the image URL to the images list
-                    images.append(img_src)
-
-            # Store all the image URLs in the product dictionary
-            product['Images'] = images
-
-            print(f"All image URLs: {images}")
-        else:
-            print('No thumbnail slider found')
-
-        # Return the complete product dictionary
-        print(f"Scraped product: {product}")
-        return product
-
-    except Exception as e:
-        print(f"Error occurred: {e}")
-        return None
-
-
-        
-
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching URL: {e}")
-        # Store the error message in the product dictionary
-        product['Error'] = str(e)
-
-    return product
-
-
 # Shopify API integration (assuming shopify package is already installed and configured)
 def connect_to_shopify(api_key, password, store_url):
     shop_url = f"https://{api_key}:{password}@{store_url}.myshopify.com/admin"
@@ -322,24 +195,23 @@ def upload_to_shopify(product_data, sku, shipping_info):
 
     return new_product
 
-@app.route('/upload_product/<string:product_id>', methods=['POST'])
+@bp.route('/upload_product/<string:product_id>', methods=['POST'])
 def upload_product(product_id):
-    # Fetch the product by its ID from MongoDB collections
-    product = collectionA.find_one({"_id": ObjectId(product_id)})
-    if not product:
-        product = collectionB.find_one({"_id": ObjectId(product_id)})
-    if not product:
-        product = collectionC.find_one({"_id": ObjectId(product_id)})
+    # Fetch the product by its ID from MongoDB
+    product = products_collection.find_one({"_id": ObjectId(product_id)})
 
     if not product:
         return jsonify({"error": "Product not found"}), 404
 
-    shop = shopify.Shop.current()
-    print(shop)
+    # Only what changed since the last push is sent to Shopify
+    outcome = sync_product(product)
+    if outcome == SYNC_FAILED:
+        return jsonify({"error": "Upload to Shopify failed"}), 502
+    return jsonify({"message": f"Product {outcome}", "outcome": outcome})
 
 
 # Route to serve frontend
-@app.route('/')
+@bp.route('/')
 def index():
     
     product = {
@@ -351,47 +223,116 @@ def index():
     }
     return render_template('frontend.html', product=product)
 
-@app.route('/products', methods=['GET'])
-def get_products():
-    # Get the brand parameter from the query string
-    brand = request.args.get('brand')
-
-    # Fetch data based on the brand
-    if brand == 'Adidas':
-        products = list(collectionA.find())
-    elif brand == 'Nike':
-        products = list(collectionB.find())
-    elif brand == 'Jordan':
-        products = list(collectionC.find())
-    else:
-        # If brand is not recognized, return an empty list or handle it as needed
-        products = []
+PRODUCTS_PAGE_SIZE = 100
+PRODUCTS_MAX_PAGE_SIZE = 500
 
-    # Convert ObjectId to string (MongoDB uses ObjectId for _id)
-    for product in products:
-        product['_id'] = str(product['_id'])
+@bp.route('/products', methods=['GET'])
+def get_products():
+    """One page of a brand's products, streamed as {"products": [...], "next": cursor}.
 
-    return jsonify(products)
+    Query parameters: brand, limit, after (the previous page's "next"),
+    fields ("grid" or a comma separated list; full documents by default),
+    sku, gender, size (only products with that size in stock), min_price, max_price.
+    """
+    args = request.args
+    try:
+        limit = int(args.get('limit', PRODUCTS_PAGE_SIZE))
+        if limit < 1:
+            # Mongo reads limit(0) and negative limits as no limit at all
+            raise ValueError('limit must be at least 1')
+        limit = min(limit, PRODUCTS_MAX_PAGE_SIZE)
+        after = ObjectId(args['after']) if args.get('after') else None
+        min_price = float(args['min_price']) if args.get('min_price') else None
+        max_price = float(args['max_price']) if args.get('max_price') else None
+    except (ValueError, InvalidId) as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+
+    # Repeat views are answered from memory, or with a 304 when the client
+    # already holds this exact page
+    cache_key = ('products', request.query_string)
+    entry = read_cache.get(cache_key)
+    if entry:
+        return cached_response(entry, 'application/json')
+    generation = read_cache.generation
+
+    fields = args.get('fields')
+    if fields == 'grid':
+        projection = GRID_PROJECTION
+    elif fields:
+        projection = {field: 1 for field in fields.split(',')}
+    else:
+        projection = None
+
+    # Unknown brands simply match nothing
+    query = product_filter(args.get('brand'), gender=args.get('gender'), size=args.get('size'),
+                           min_price=min_price, max_price=max_price, after=after, sku=args.get('sku'))
+    # One extra document tells us whether there is a next page
+    cursor = products_collection.find(query, projection).sort('_id', 1).limit(limit + 1)
+
+    def page():
+        yield '{"products": ['
+        last_id = None
+        for count, product in enumerate(cursor):
+            if count == limit:
+                yield f'], "next": "{last_id}"}}'
+                return
+            # Convert ObjectId to string (MongoDB uses ObjectId for _id)
+            last_id = product['_id'] = str(product['_id'])
+            yield (',' if count else '') + json.dumps(product, default=str)
+        yield '], "next": null}'
+
+    if request.if_none_match:
+        # A revalidation: build the whole page so its ETag (a hash of the body) can be compared
+        entry = read_cache.set(cache_key, ''.join(page()), tags=[args.get('brand')], generation=generation)
+        return cached_response(entry, 'application/json')
+
+    def generate():
+        # Stream the page and keep a copy for the cache once it is complete; the
+        # body is not known when the headers go out, so the ETag comes with the copy
+        chunks = []
+        for chunk in page():
+            chunks.append(chunk)
+            yield chunk
+        read_cache.set(cache_key, ''.join(chunks), tags=[args.get('brand')], generation=generation)
+
+    response = Response(generate(), mimetype='application/json')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cached_response(entry, mimetype):
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.value, mimetype=mimetype)
+    response.set_etag(entry.etag)
+    # Let browsers keep the body but revalidate it on every view
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-@app.route('/product/<string:product_id>', methods=['GET', 'POST'])
+@bp.route('/product/<string:product_id>', methods=['GET', 'POST'])
 def get_product_detail(product_id):
-    # Fetch the product by its ID from MongoDB collections
-    product = collectionA.find_one({"_id": ObjectId(product_id)})
-    if not product:
-        product = collectionB.find_one({"_id": ObjectId(product_id)})
-    if not product:
-        product = collectionC.find_one({"_id": ObjectId(product_id)})
+    cache_key = ('product', product_id)
+    if request.method == 'GET':
+        entry = read_cache.get(cache_key)
+        if entry:
+            return cached_response(entry, 'text/html')
+    generation = read_cache.generation
+
+    # Fetch the product by its ID from MongoDB
+    product = products_collection.find_one({"_id": ObjectId(product_id)})
 
     if request.method == 'POST':
         # Handle price update
         new_price = request.form.get('price')
         if new_price:
-            collectionA.update_one({'_id': ObjectId(product_id)}, {'$set': {'price': new_price}})
+            products_collection.update_one({'_id': ObjectId(product_id)},
+                                           {'$set': {'price': new_price, 'updated_at': datetime.now(timezone.utc)}})
             product['price'] = new_price
 
         # Handle image upload
@@ -399,154 +340,123 @@ def get_product_detail(product_id):
         if 'image' in request.files:
             file = request.files['image']
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
+                try:
+                    image = store_image(file.stream, secure_filename(file.filename))
+                except ImageTooLarge as e:
+                    return str(e), 413
 
                 # Update the specific image at the given index
-                product['Images'][image_index] = f'/uploads/{filename}'  # Update image URL
-                collectionA.update_one({'_id': ObjectId(product_id)}, {'$set': {'Images': product['Images']}})
+                product['Images'][image_index] = image_url(image['filename'])  # Update image URL
+                products_collection.update_one({'_id': ObjectId(product_id)}, {'$set': {
+                    'Images': product['Images'], 'updated_at': datetime.now(timezone.utc)}})
 
-        return redirect(url_for('get_product_detail', product_id=product_id))
+        # Drop the cached detail page and the brand's cached product lists
+        read_cache.invalidate(product_id, product.get('brand'))
+        return redirect(url_for('main.get_product_detail', product_id=product_id))
 
     if product:
         product['_id'] = str(product['_id'])  # Convert ObjectId to string for frontend rendering
-        return render_template('product_detail.html', product=product)
+        html = render_template('product_detail.html', product=product)
+        entry = read_cache.set(cache_key, html, tags=[product_id, product.get('brand')], generation=generation)
+        return cached_response(entry, 'text/html')
     else:
         return "Product not found", 404
     
-# Route for scraping and storing data
+# Route for scraping and storing data: the scrape itself runs as a background job
 @socketio.on('scrape')
 def scrape(data):
-    global scraped_data
-    print("Received scraping request: ", data)  # Add print statement for debugging
-    url = data.get('url')
-    brand = data.get('brand')
-# Append brand-specific path to the base URL
-    if brand.lower() == 'adidas':
-        url += '/collections/adidas'
-    elif brand.lower() == 'nike':
-        url += '/collections/nike'
-    elif brand.lower() == 'jordan':
-        url += '/collections/jordan'
-    
-    # Emit real-time updates via SocketIO
-    socketio.emit('update', {'message': f'Starting to scrape {brand} products...'})
-    socketio.sleep(1) # Simulate delay
-
-     # Fetch the main product collection page
-    session = requests_retry_session()
-    response = session.get(url, headers=headers, timeout=10)
-
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to fetch the page'}), 400
-
-    soup = BeautifulSoup(response.content, 'html.parser')
-
-    # Find all products on the collection page
-    products = []
-    for item in soup.select('a.collection-item'):
-        product_url = item['href']
-        product_name = item.text.strip()
-        products.append({
-            'name': product_name,
-            'link': product_url
-        })
-
-    # Scrape detailed information from each product page
-    scraped_products = []
-
-    for product in products:
-        product_detail_url = f"https://usgstore.com.au{product['link']}"
-        product_response = requests.get(product_detail_url)
-
-        if product_response.status_code == 200:
-            product_data = scrape_product(product_detail_url, brand)
-            if product_data:
-                # Save the scraped product data to MongoDB
-                gender = product_data.get('Gender', '').strip()  # Ensure to strip any leading/trailing spaces
-                print("gender: ", gender)  # Debugging to see the actual gender value
-                # Make comparison case-insensitive
-                if gender.lower() not in ["mens footwear", "womens footwear"]:
-                    continue
-            
-                product_item = {
-                    "sku": product_data.get('SKU'),
-                    "title": product_data.get('Title'),
-                    "brand": product_data.get('Brand'),
-                    "color": product_data.get('Color'),
-                    "gender": product_data.get('Gender'),
-                    "material": product_data.get('Material'),
-                    "age_group": product_data.get('Age group'),
-                    "size": product_data.get('Size'),
-                    "barcode": product_data.get('Barcode'),
-                    "weight": product_data.get('Weight'),
-                    "quantity": product_data.get('Quantity'),
-                    "Variants": product_data.get('Variants'),
-                    "Images": product_data.get('Images'),
-                    "product_detail": product_data.get('product_detail'),
-                    "price": product_data.get("price")
-                }
-                if product_item["brand"] == "Adidas":
-                    collection = collectionA
-                elif product_item["brand"] == "Nike":
-                    collection = collectionB
-                elif product_item["brand"] == "Jordan":
-                    collection = collectionC
-                else:
-                    print(f"Brand {product_item['brand']} is not supported.")
-                    return  # Exit the function or handle other brands accordingly
-                # Check if the product with the same SKU already exists
-                existing_product = collection.find_one({"sku": product_item["sku"]})
-
-                if existing_product:
-                    # If the product exists, check for changes
-                    # If there are any changes, update the record
-                    if existing_product != product_item:
-                        collection.update_one({"sku": product_item["sku"]}, {"$set": product_item})
-                        print(f"Product with SKU {product_item['sku']} updated in MongoDB.")
-                else:
-                    # If the product does not exist, insert it into the database
-                    collection.insert_one(product_item)
-                    print(f"Product with SKU {product_item['sku']} inserted into MongoDB.")
-            
-                # Emit the scraped data for each product immediately
-                socketio.emit('update', {
-                    'message': f"Scraped and saved product: {product_data['Title']}",
-                    'product': {
-                        'Image': product_data.get('Images')[0] if product_data.get('Images') and len(product_data.get('Images')) > 0 else '',
-                        'Title': product_data.get('Title', 'N/A'),
-                        'Brand': product_data.get('Brand', 'N/A'),
-                        'Color': product_data.get('Color', 'N/A'),
-                        'Gender': product_data.get('Gender', 'N/A'),
-                        'Material': product_data.get('Material', 'N/A'),
-                        'Age group': product_data.get('Age group', 'N/A'),
-                        'Size': product_data.get('Size', 'N/A'),
-                        'SKU': product_data.get('SKU', 'N/A'),
-                        'Barcode': product_data.get('Barcode', 'N/A'),
-                        'Weight': product_data.get('Weight', 'N/A'),
-                        'Product detail': product_data.get('product_detail', 'N/A'),
-                        'Quantity': product_data.get('Quantity', 'N/A'),
-                        'Variants': product_data.get('Variants', []),
-                    }
-                })
-                socketio.sleep(1)
-            else:
-                # Emit a message indicating that scraping failed for this product
-                socketio.emit('update', {'message': f"Failed to scrape product: {product['name']}"})
-                socketio.sleep(1)
-        else:
-            # Emit a message indicating that fetching the product detail page failed
-            socketio.emit('update', {'message': f"Failed to fetch product detail page for: {product['name']}"})
-            socketio.sleep(1)
-
-    # Emit a completion message after all products are processed
-    socketio.emit('update', {'message': 'All products have been processed.'})
-    socketio.sleep(1)
-
-
-    # # Return all scraped data as JSON at the end of the process
-    # return jsonify({'products': scraped_products})
+    logger.info('Received scraping request', extra={'request': data})
+    job_id, created = enqueue_scrape(data.get('url'), data.get('brand'), data.get('mode'))
+    if created:
+        message = f"Queued scrape of {data.get('brand')} products (job {job_id})"
+    else:
+        message = f"A scrape of {data.get('brand')} is already queued or running (job {job_id})"
+    # Progress of the job is only sent to clients watching its room
+    join_room(job_room(job_id))
+    emit('update', {'message': message, 'job_id': str(job_id)})
+
+@socketio.on('watch_job')
+def watch_job(data):
+    join_room(job_room(data.get('job_id')))
+
+# Clients showing a brand's grid get its 'catalog' changes (see change_feed.py)
+@socketio.on('watch_catalog')
+def watch_catalog(data):
+    join_room(catalog_room(data.get('brand')))
+
+@socketio.on('unwatch_catalog')
+def unwatch_catalog(data):
+    leave_room(catalog_room(data.get('brand')))
+
+@bp.route('/jobs', methods=['GET', 'POST'])
+def jobs():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        if not data.get('url') or not data.get('brand'):
+            return jsonify({"error": "url and brand are required"}), 400
+        job_id, created = enqueue_scrape(data['url'], data['brand'], data.get('mode'))
+        return jsonify(public_job(jobs_collection.find_one({'_id': job_id}))), 201 if created else 200
+
+    # Most recent jobs first, optionally only those in one state
+    query = {'state': request.args['state']} if request.args.get('state') else {}
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    if limit < 1:
+        return jsonify({"error": "Invalid query parameter: limit must be at least 1"}), 400
+    limit = min(limit, 100)
+    recent = jobs_collection.find(query, {'checkpoint': 0}).sort('created_at', -1).limit(limit)
+    return jsonify([public_job(job) for job in recent])
+
+@bp.route('/jobs/<string:job_id>', methods=['GET'])
+def job_detail(job_id):
+    try:
+        job = jobs_collection.find_one({'_id': ObjectId(job_id)}, {'checkpoint': 0})
+    except InvalidId:
+        job = None
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(public_job(job))
+
+@bp.route('/healthz')
+def liveness():
+    # The process is up and serving; dependencies are /readyz's business
+    return jsonify({"status": "ok"})
+
+def shopify_check():
+    """shopify_status() within READINESS_TIMEOUT. A slower location lookup carries on
+    in the background and is cached for the next check."""
+    lookup = eventlet.spawn(shopify_status)
+    try:
+        with eventlet.Timeout(READINESS_TIMEOUT):
+            return lookup.wait()
+    except eventlet.Timeout:
+        return {"ok": False, "error": f"Shopify did not answer within {READINESS_TIMEOUT}s"}
+
+@bp.route('/readyz')
+def readiness():
+    """Dependency health. Mongo is required; without Shopify the catalog is
+    still served, so it only marks the app as degraded."""
+    checks = {}
+    try:
+        with pymongo.timeout(READINESS_TIMEOUT):
+            client.admin.command('ping')
+        checks['mongo'] = {"ok": True}
+    except PyMongoError as e:
+        checks['mongo'] = {"ok": False, "error": str(e)}
+    checks['shopify'] = shopify_check()
+
+    if not checks['mongo']['ok']:
+        return jsonify({"status": "unavailable", "checks": checks}), 503
+    return jsonify({"status": "ready" if checks['shopify']['ok'] else "degraded", "checks": checks})
+
+@bp.route('/metrics')
+def metrics():
+    # Prometheus scrape target: stage timings and counters of this process
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+app = create_app()
 
 # Run the app
 if __name__ == '__main__':
@@ -0,0 +1,170 @@
+"""Parse time per page, and a check that every parser backend extracts what
+the original scraper did.
+
+    python benchmarks/bench_parse.py [--products N] [--repeat N] [collection pages...]
+
+Product pages are rendered from the admin.*.json dumps the way
+benchmarks/standin.py serves them. Each backend's parse_product (the
+html.parser full tree, the strained lxml tree, and selectolax when installed)
+is timed over them and compared, page by page, with the baseline: the
+extraction scrape_product did before parsers.py existed, a full
+BeautifulSoup(html.parser) tree searched with find(). Collection links are
+compared the same way on the saved usgstore.com.au pages.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+sys.path.insert(0, BENCHMARKS)
+import parsers  # noqa: E402
+import standin  # noqa: E402
+
+
+def baseline_product(content, brand):
+    """scrape_product's extraction before parsers.py, minus the fetch and prints."""
+    product = {}
+    variants = []
+    try:
+        soup = BeautifulSoup(content, 'html.parser')
+        product['Title'] = soup.find('h3').get_text(strip=True)
+        product['Brand'] = brand
+        product['Color'] = soup.find('h4').get_text(strip=True)
+        product['Material'] = 'Leather'
+        product['Age group'] = 'Adult'
+
+        price_meta_tag = soup.find('meta', property='og:price:amount')
+        product['price'] = price_meta_tag.get('content') if price_meta_tag else 'Price not found'
+
+        script_tag = soup.find('script', string=re.compile('new Shopify\\.OptionSelectors'))
+        if script_tag:
+            script_content = script_tag.string
+            size_match = re.search(r'"Size":"(.*?)"', script_content)
+            sku_match = re.search(r'"sku":"(.*?)"', script_content)
+            barcode_match = re.search(r'"barcode":"(.*?)"', script_content)
+            weight_match = re.search(r'"weight":(\d+)', script_content)
+            quantity_match = re.search(r'"inventory_quantity":(\d+)', script_content)
+            id_match = re.search(r'"id":(\d+)', script_content)
+            gender_match = re.search(r'"type":"(.*?)"', script_content)
+            product['Size'] = size_match.group(1) if size_match else 'Size not found'
+            product['SKU'] = sku_match.group(1) if sku_match else 'SKU not found'
+            product['Barcode'] = barcode_match.group(1) if barcode_match else 'Barcode not found'
+            product['Weight'] = weight_match.group(1) if weight_match else 'Weight not found'
+            product['Quantity'] = quantity_match.group(1) if quantity_match else 'Quantity not found'
+            product['id'] = id_match.group(1) if id_match else 'ID not found'
+            product['Gender'] = gender_match.group(1) if gender_match else 'gender not found'
+
+            product_data_match = re.search(r'product:\s*(\{.*\})', script_content)
+            if product_data_match:
+                product_data = json.loads(product_data_match.group(1))
+                product['id'] = product_data.get('id', 'ID not found')
+                for variant in product_data['variants']:
+                    variants.append({
+                        'Size': variant.get('option2', 'Size not found'),
+                        'ID': variant.get('id', 'ID not found'),
+                        'SKU': variant.get('sku', 'SKU not found'),
+                        'Barcode': variant.get('barcode', 'Barcode not found'),
+                        'Quantity': variant.get('inventory_quantity', 'Quantity not found'),
+                        'Weight': variant.get('weight', 'Weight not found')
+                    })
+        product['Variants'] = variants
+
+        details_div = soup.find('div', class_='product-details-tabs-description-flex-col')
+        if details_div:
+            ul_tag = details_div.find('ul')
+            if ul_tag:
+                list_items = [li.get_text(strip=True) for li in ul_tag.find_all('li')]
+                product['product_detail'] = "\n".join(list_items).replace('USG', 'GOOD LOOKS')
+            else:
+                product = {'product_detail': 'No list found'}
+        else:
+            product = {'product_detail': 'Details not found'}
+
+        thumbnail_slider = soup.find('div', class_='product-image-slider')
+        if thumbnail_slider:
+            images = []
+            for img_tag in thumbnail_slider.find_all('img'):
+                if img_tag and 'src' in img_tag.attrs:
+                    img_src = img_tag['src']
+                    if img_src.startswith('//'):
+                        img_src = 'https:' + img_src
+                    images.append(img_src)
+            product['Images'] = images
+        return product
+    except Exception:
+        return None
+
+
+def baseline_links(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    return [{'name': item.text.strip(), 'link': item['href']} for item in soup.select('a.collection-item')]
+
+
+BACKENDS = {
+    'html.parser (full tree)': lambda content: parsers.SoupPage(BeautifulSoup(content, 'html.parser')),
+    f'{parsers.SOUP_PARSER} + SoupStrainer': parsers.SoupPage.parse,
+}
+if parsers.HTMLParser:
+    BACKENDS['selectolax'] = parsers.SelectolaxPage.parse
+
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def product_pages(limit=None):
+    """(brand, content) of the stand-in's product pages."""
+    site = standin.Site('http://standin.test')
+    pages = [(path.split('/')[2].capitalize(), content) for path, (_, content) in sorted(site.products.items())]
+    return pages[:limit] if limit else pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', default=sorted(glob.glob(os.path.join(standin.PAGES_DIR, '*'))),
+                        help='saved collection pages for the link comparison')
+    parser.add_argument('--products', type=int, help='parse only the first N product pages')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    pages = product_pages(args.products)
+    size = sum(len(content) for _, content in pages) // len(pages) // 1024
+    print(f"{len(pages)} product pages ({size} KB each on average)")
+
+    ms, expected = time_per_call(lambda: [baseline_product(content, brand) for brand, content in pages], args.repeat)
+    print(f"  baseline        {'html.parser find()':<28} {ms / len(pages):8.2f} ms/page")
+    extracted = sum(1 for product in expected if product and product.get('Variants'))
+    if extracted < len(pages):
+        print(f"  baseline extracted variants from only {extracted} of {len(pages)} pages")
+
+    for name, page in BACKENDS.items():
+        ms, products = time_per_call(
+            lambda: [parsers.parse_product(content, brand, page=page(content)) for brand, content in pages],
+            args.repeat)
+        mismatches = sum(1 for product, baseline in zip(products, expected) if product != baseline)
+        print(f"  parse_product   {name:<28} {ms / len(pages):8.2f} ms/page"
+              f"  ({mismatches} of {len(pages)} differ from the baseline)")
+
+    for path in args.pages:
+        with open(path, 'rb') as f:
+            content = f.read()
+        print(f"{os.path.basename(path)} ({len(content) // 1024} KB)")
+        before, links_before = time_per_call(lambda: baseline_links(content), args.repeat)
+        after, links_after = time_per_call(lambda: parsers.parse_collection_links(content), args.repeat)
+        print(f"  collection links html.parser (full tree)  {before:8.2f} ms/page")
+        print(f"  collection links {parsers.SOUP_PARSER + ' + SoupStrainer':<25} {after:8.2f} ms/page"
+              f"  ({len(links_after)} links, identical: {links_before == links_after})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Throughput, latency, request counts and peak memory of the scrape -> store
+-> publish pipeline, measured offline.
+
+    python benchmarks/bench_pipeline.py [--brand Adidas] [--output results.json]
+    python benchmarks/bench_pipeline.py --mongo-uri mongodb://localhost:27017
+
+The store and the Shopify Admin API are played by benchmarks/standin.py (saved
+usgstore.com.au pages, product pages rendered from the admin.*.json dumps,
+Shopify's call limit and response headers), started on a free port for the
+run. Mongo is mongomock, or with --mongo-uri a scratch database on a local
+mongod ("goodlooks_bench", dropped afterwards). The dumps are loaded first.
+
+Stages:
+
+    scrape_product                    each product page of the collection in turn, first visit
+    scrape_product_revisit            the same pages again (the stand-in answers 304)
+    scrape                            run_scrape over the collection (pages fetched concurrently)
+    products                          every /products page of the catalog, read cache cleared first
+    products_cached                   the same pages answered from the read cache
+    upload_product_to_shopify         first upload of --upload-products products (create + inventory)
+    upload_product_to_shopify_update  the same products again (find + save)
+
+Each stage reports products/s, p50/p99 latency per call, the HTTP requests
+the stand-in received and peak traced memory (tracemalloc, which slows the
+stage down a little; --no-memory leaves it off). The report is JSON, so runs
+can be compared across releases.
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse  # noqa: E402
+import contextlib  # noqa: E402
+import json  # noqa: E402
+import math  # noqa: E402
+import os  # noqa: E402
+import platform  # noqa: E402
+import resource  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+import tracemalloc  # noqa: E402
+from datetime import datetime, timezone  # noqa: E402
+
+import requests  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STANDIN = os.path.join(ROOT, 'benchmarks', 'standin.py')
+DUMPS = ['admin.adidas.json', 'admin.nike.json', 'admin.jordan.json']
+# Takes the place of the app's "admin" database for the run
+BENCH_DB = 'goodlooks_bench'
+
+sys.path.insert(0, ROOT)
+
+
+def start_standin(args):
+    process = subprocess.Popen([sys.executable, STANDIN, '--site-latency', str(args.site_latency),
+                                '--shopify-latency', str(args.shopify_latency),
+                                '--shopify-bucket', str(args.shopify_bucket),
+                                '--shopify-leak-rate', str(args.shopify_leak_rate),
+                                # Calls that lose the token on the way fail like they would on Shopify
+                                '--access-token', os.environ['ACCESS_TOKEN']],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('listening on '):
+        process.kill()
+        raise RuntimeError(f"standin.py did not start: {line!r}")
+    return process, line.split()[-1]
+
+
+def standin_stats(base_url):
+    return requests.get(f'{base_url}/__stats', timeout=10).json()
+
+
+def use_bench_database(mongo_uri):
+    """Point every MongoClient the app creates at the scratch database."""
+    import pymongo
+    if mongo_uri:
+        base = pymongo.MongoClient
+    else:
+        import mongomock
+        base = mongomock.MongoClient
+
+    class BenchClient(base):
+        def __getitem__(self, name):
+            return super().__getitem__(BENCH_DB if name == 'admin' else name)
+
+    pymongo.MongoClient = BenchClient
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] if ordered else None
+
+
+class Stage:
+    """Times one stage: call() wraps each unit of work, the block as a whole
+    gives the wall time, request counts and peak memory."""
+
+    def __init__(self, name, base_url, memory=True):
+        self.name = name
+        self.base_url = base_url
+        self.memory = memory
+        self.latencies = []
+        self.products = 0
+        self.extra = {}
+
+    def call(self, fn, *args, products=1):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+            self.products += products
+
+    def __enter__(self):
+        self.requests_before = standin_stats(self.base_url)
+        if self.memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        self.peak_memory = tracemalloc.get_traced_memory()[1] if self.memory else None
+        if self.memory:
+            tracemalloc.stop()
+        after = standin_stats(self.base_url)
+        self.requests = {key: count - self.requests_before.get(key, 0) for key, count in after.items()
+                         if count != self.requests_before.get(key, 0)}
+        return False
+
+    def result(self):
+        ms = [latency * 1000 for latency in self.latencies]
+        return dict({
+            'products': self.products,
+            'seconds': round(self.seconds, 3),
+            'products_per_sec': round(self.products / self.seconds, 2) if self.seconds else None,
+            'calls': len(ms),
+            'p50_ms': round(percentile(ms, 0.5), 2) if ms else None,
+            'p99_ms': round(percentile(ms, 0.99), 2) if ms else None,
+            'max_ms': round(max(ms), 2) if ms else None,
+            'requests': self.requests,
+            'peak_memory_mb': round(self.peak_memory / 2 ** 20, 2) if self.peak_memory is not None else None,
+        }, **self.extra)
+
+
+def load_catalog(migrate_products, json_util):
+    migrate_products.ensure_product_indexes()
+    for dump in DUMPS:
+        with open(os.path.join(ROOT, dump)) as f:
+            migrate_products.migrate(json_util.loads(f.read()), dump)
+
+
+def run(args, base_url):
+    from bson import json_util
+
+    import app
+    import fetcher
+    import migrate_products
+    import parsers
+    import scraper
+    import shopify
+    import shopify_client
+    from cache import read_cache
+    from storage import products_collection
+    from upload_shopify import shop_url, upload_product_to_shopify
+
+    # Every Shopify call goes to the stand-in
+    shopify.ShopifyResource.set_site(shop_url.replace(shopify_client.shop_admin_url, f'{base_url}/admin'))
+    shopify_client.graphql_url = shopify_client.graphql_url.replace(shopify_client.shop_admin_url, f'{base_url}/admin')
+
+    app.ensure_indexes()
+    load_catalog(migrate_products, json_util)
+    stages = {}
+
+    response = fetcher.fetch(f'{base_url}/collections/{args.brand.lower()}')
+    response.raise_for_status()
+    urls = [f"{base_url}{link['link']}" for link in parsers.parse_collection_links(response.content)]
+
+    scraper.validators_collection.delete_many({})
+    for name in ('scrape_product', 'scrape_product_revisit'):
+        with Stage(name, base_url, args.memory) as stage:
+            for url in urls:
+                status, _, validator = stage.call(scraper.scrape_product, url, args.brand)
+                if validator:
+                    # As run_scrape does once the product is written, so the revisit gets 304s
+                    scraper.record_validators([(url, validator)])
+                stage.extra.setdefault('outcomes', {}).setdefault(status, 0)
+                stage.extra['outcomes'][status] += 1
+        stages[name] = stage.result()
+
+    # The whole loop: collection page, concurrent product pages, bulk writes
+    scraper.validators_collection.delete_many({})
+    with Stage('scrape', base_url, args.memory) as stage:
+        scrape_product = scraper.scrape_product
+        scraper.scrape_product = lambda *args: stage.call(scrape_product, *args)
+        try:
+            stage.extra['outcomes'] = scraper.run_scrape(base_url, args.brand, mode='html')
+        finally:
+            scraper.scrape_product = scrape_product
+    stages['scrape'] = stage.result()
+
+    client = app.app.test_client()
+    pages = []
+    for brand in products_collection.distinct('brand'):
+        for fields in ('', '&fields=grid'):
+            after = ''
+            while True:
+                url = f'/products?brand={brand}&limit={args.page_size}{fields}{after}'
+                body = json.loads(client.get(url).get_data())
+                pages.append((url, len(body['products'])))
+                if not body['next']:
+                    break
+                after = f"&after={body['next']}"
+
+    for name, cached in (('products', False), ('products_cached', True)):
+        with Stage(name, base_url, args.memory) as stage:
+            for url, count in pages:
+                if not cached:
+                    read_cache.invalidate()
+                stage.call(lambda: client.get(url).get_data(), products=count)
+        stages[name] = stage.result()
+
+    sample = list(products_collection.find({'brand': args.brand}).sort('_id', 1).limit(args.upload_products))
+    for name in ('upload_product_to_shopify', 'upload_product_to_shopify_update'):
+        with Stage(name, base_url, args.memory) as stage:
+            for m_product in sample:
+                stage.call(upload_product_to_shopify, m_product)
+        stages[name] = stage.result()
+
+    return stages, parsers.PARSER_BACKEND
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--brand', default='Adidas', help='collection scraped and uploaded')
+    parser.add_argument('--mongo-uri', help='use this mongod (scratch database) instead of mongomock')
+    parser.add_argument('--upload-products', type=int, default=5, help='products uploaded to the Shopify stand-in')
+    parser.add_argument('--page-size', type=int, default=100, help='limit of each /products request')
+    parser.add_argument('--site-latency', type=float, default=0.05, help='mean seconds per store page')
+    parser.add_argument('--shopify-latency', type=float, default=0.15, help='mean seconds per Shopify call')
+    parser.add_argument('--shopify-bucket', type=int, default=40)
+    parser.add_argument('--shopify-leak-rate', type=float, default=2.0)
+    parser.add_argument('--rate-per-host', type=float, default=0,
+                        help='SCRAPE_RATE_PER_HOST for the run (0: no politeness delay)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip tracemalloc')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    # Settings are read when the app's modules are imported
+    os.environ.update({
+        'SCRAPE_RATE_PER_HOST': str(args.rate_per_host),
+        'MIRROR_IMAGES': '0',
+        'EMBEDDED_WORKERS': '0',
+        'CHANGE_FEED': '0',
+        'LOG_LEVEL': 'WARNING',
+        'ACCESS_TOKEN': 'bench',
+        'IMAGE_STORE': tempfile.mkdtemp(prefix='bench-images-'),
+    })
+    if args.mongo_uri:
+        os.environ['MONGODB_URI'] = args.mongo_uri
+    use_bench_database(args.mongo_uri)
+
+    process, base_url = start_standin(args)
+    started_at = datetime.now(timezone.utc)
+    try:
+        # The app's own prints would drown the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            stages, parser_backend = run(args, base_url)
+    finally:
+        process.terminate()
+        if args.mongo_uri:
+            import pymongo
+            pymongo.MongoClient(args.mongo_uri).drop_database(BENCH_DB)
+
+    report = {
+        'benchmark': 'pipeline',
+        'started_at': started_at.isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mongo': 'mongod' if args.mongo_uri else 'mongomock',
+        'parser_backend': parser_backend,
+        'config': {key: value for key, value in vars(args).items() if key not in ('mongo_uri', 'output')},
+        'stages': stages,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""Local stand-in for usgstore.com.au and the Shopify Admin REST API.
+
+    python benchmarks/standin.py [--port 0] [--site-latency 0.05] [--shopify-latency 0.15] [--page-size 48]
+
+Collection pages are the saved pages in usgstore.com.au/ (or collection.txt
+with links to the brand's products, --page-size to a ?page=N page, when no
+page was saved for the brand). Product pages are rendered from the
+admin.*.json catalog dumps into the saved page's markup, so they weigh what a
+real page does, and carry an ETag so revisits can be answered 304.
+/sitemap.xml lists every product with a fixed <lastmod>.
+
+Everything under /admin/api/ answers like Shopify: products, locations and
+inventory levels are kept in memory, every call goes through a 40-call
+bucket leaking 2 per second with X-Shopify-Shop-Api-Call-Limit on the
+response, and a full bucket answers 429 with Retry-After. With
+--access-token, calls without that X-Shopify-Access-Token get a 401.
+
+GET /__stats returns the request counts so far. The first line printed is
+"listening on http://127.0.0.1:<port>".
+"""
+import argparse
+import hashlib
+import html
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES_DIR = os.path.join(ROOT, 'usgstore.com.au')
+DUMPS = {'adidas': 'admin.adidas.json', 'nike': 'admin.nike.json', 'jordan': 'admin.jordan.json'}
+
+SITEMAP_XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+PRODUCT_LINK = re.compile(r'<a class="collection-item[^"]*"[^>]*href="([^"]+)"')
+
+
+def load_dump(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def variant_id(value):
+    # Extended JSON from mongoexport: {"$numberLong": "..."}
+    return int(value['$numberLong']) if isinstance(value, dict) else value
+
+
+class Site:
+    """Pages of one store, built once at start-up."""
+
+    def __init__(self, base_url, page_size=48):
+        self.base_url = base_url
+        self.page_size = page_size
+        with open(os.path.join(PAGES_DIR, 'collection.txt'), encoding='utf-8') as f:
+            shell = f.read()
+        body = shell.index('>', shell.index('<body', shell.index('</head>'))) + 1
+        # Theme markup around the product: everything but the collection grid
+        self.head, self.tail = shell[:body], PRODUCT_LINK.sub('<a href="#">', shell[body:])
+        self.collections = {}  # path -> [page 1, page 2, ...]
+        self.products = {}  # path -> (etag, page)
+        for brand, dump in DUMPS.items():
+            self.add_brand(brand, load_dump(os.path.join(ROOT, dump)))
+        self.sitemaps = self.make_sitemaps()
+
+    def add_brand(self, brand, documents):
+        saved = os.path.join(PAGES_DIR, f'{brand}.txt')
+        if os.path.exists(saved):
+            with open(saved, encoding='utf-8') as f:
+                page = f.read()
+            links = PRODUCT_LINK.findall(page)
+            self.collections[f'/collections/{brand}'] = [page.encode()]
+        else:
+            links = [f"/collections/{brand}/products/{brand}-{i}" for i in range(len(documents))]
+            pages = range(0, len(links), self.page_size)
+            pagination = ''.join(f'<a class="pagination-link" href="/collections/{brand}?page={n + 1}">{n + 1}</a>'
+                                 for n in range(len(pages)))
+            self.collections[f'/collections/{brand}'] = [(self.head + ''.join(
+                f'<a class="collection-item w-inline-block" href="{link}">{html.escape(d["title"])}</a>'
+                for link, d in zip(links[start:start + self.page_size], documents[start:start + self.page_size])
+            ) + pagination + self.tail).encode() for start in pages]
+        # More links than products in the dump: reuse them under a new SKU
+        for i, link in enumerate(links):
+            document = documents[i % len(documents)]
+            suffix = f'-{i // len(documents)}' if i >= len(documents) else ''
+            content = self.product_page(document, suffix).encode()
+            self.products[link] = (hashlib.sha1(content).hexdigest(), content)
+
+    def make_sitemaps(self):
+        urls = ''.join(f'<url><loc>{self.base_url}/products/{link.rsplit("/", 1)[-1]}</loc>'
+                       f'<lastmod>2024-10-01T00:00:00+10:00</lastmod></url>' for link in self.products)
+        return {
+            '/sitemap.xml': (f'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{SITEMAP_XMLNS}">'
+                             f'<sitemap><loc>{self.base_url}/sitemap_products_1.xml</loc></sitemap>'
+                             f'</sitemapindex>').encode(),
+            '/sitemap_products_1.xml': (f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{SITEMAP_XMLNS}">'
+                                        f'{urls}</urlset>').encode(),
+        }
+
+    def product_page(self, document, suffix=''):
+        variants = [{
+            'id': variant_id(v['ID']), 'sku': (v['SKU'] or '') + suffix, 'barcode': v['Barcode'],
+            'inventory_quantity': v['Quantity'], 'weight': v['Weight'],
+            'option1': document['color'], 'option2': v['Size'],
+        } for v in document['Variants']]
+        product = {'id': variant_id(document['Variants'][0]['ID']) if document['Variants'] else 1,
+                   'title': document['title'], 'type': document['gender'], 'vendor': document['brand'],
+                   'variants': variants}
+        images = ''.join(f'<div class="slide"><img src="{src.replace("https://usgstore.com.au", self.base_url)}">'
+                         f'</div>' for src in document['Images'])
+        details = ''.join(f'<li>{html.escape(line)}</li>' for line in document['product_detail'].split('\n'))
+        return (
+            self.head.replace('</head>', f'<meta property="og:price:amount" content="{document["price"]}"></head>')
+            + f'<h3>{html.escape(document["title"])}</h3><h4>{html.escape(document["color"] or "")}</h4>'
+            + f'<div class="product-image-slider"><div>{images}</div>\n</div>'
+            + f'<div class="product-details-tabs-description-flex-col"><ul>{details}</ul></div>'
+            + '<script>\njQuery(function($) {\n  new Shopify.OptionSelectors("productSelect", {\n'
+            + f'    product: {json.dumps(product, separators=(",", ":"))},\n'
+            + '    onVariantSelected: selectCallback\n  });\n});\n</script>'
+            + self.tail
+        )
+
+
+class FakeShopify:
+    """Just enough of the Admin REST API for the uploads, with its rate limit."""
+
+    def __init__(self, bucket=40, leak_rate=2.0):
+        self.capacity = bucket
+        self.leak_rate = leak_rate
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.products = {}
+        self.ids = itertools.count(7000000000000)
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Count one call against the bucket; False when it is full (429)."""
+        with self.lock:
+            now = time.monotonic()
+            self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+            self.updated = now
+            if self.level + 1 > self.capacity:
+                return False
+            self.level += 1
+            return True
+
+    def call_limit(self):
+        return f"{int(self.level)}/{self.capacity}"
+
+    def save_product(self, data, product_id=None):
+        with self.lock:
+            product = self.products.get(product_id) or {'id': next(self.ids), 'variants': []}
+            product.update({k: v for k, v in data.items() if k != 'variants'})
+            if 'variants' in data:
+                variants = []
+                for variant in data['variants']:
+                    variant = dict(variant)
+                    if not variant.get('id'):
+                        variant['id'] = next(self.ids)
+                        variant['inventory_item_id'] = next(self.ids)
+                    variant['product_id'] = product['id']
+                    variants.append(variant)
+                product['variants'] = variants
+            self.products[product['id']] = product
+            return product
+
+    def handle(self, method, path, query, body):
+        """(status, payload) for one REST call; path is relative to /admin/api/<version>/."""
+        if method == 'GET' and path == 'locations.json':
+            return 200, {'locations': [{'id': 1, 'name': 'Bench warehouse'}]}
+        if method == 'GET' and path == 'products.json':
+            since_id = int(query.get('since_id', ['0'])[0])
+            limit = int(query.get('limit', ['50'])[0])
+            with self.lock:
+                products = sorted((p for p in self.products.values() if p['id'] > since_id), key=lambda p: p['id'])
+            return 200, {'products': products[:limit]}
+        if method == 'POST' and path == 'products.json':
+            return 201, {'product': self.save_product(body['product'])}
+        if method == 'POST' and path == 'inventory_levels/set.json':
+            return 200, {'inventory_level': dict(body, updated_at=time.strftime('%Y-%m-%dT%H:%M:%S'))}
+        match = re.match(r'products/(\d+)\.json$', path)
+        if match:
+            product_id = int(match.group(1))
+            if product_id not in self.products:
+                return 404, {'errors': 'Not Found'}
+            if method == 'GET':
+                return 200, {'product': self.products[product_id]}
+            if method == 'PUT':
+                return 200, {'product': self.save_product(body['product'], product_id)}
+        return 404, {'errors': 'Not Found'}
+
+
+def make_handler(site, shopify, stats, site_latency, shopify_latency, seed, access_token=None):
+    rng = random.Random(seed)
+
+    def jitter(latency):
+        # Real response times vary; spread them around the mean
+        return latency * rng.uniform(0.5, 1.5) if latency else 0
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real servers
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, status, content, content_type='text/html; charset=utf-8', headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self.route('GET')
+
+        def do_POST(self):
+            self.route('POST')
+
+        def do_PUT(self):
+            self.route('PUT')
+
+        def route(self, method):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            if url.path == '/__stats':
+                return self.send(200, json.dumps(dict(stats)).encode(), 'application/json')
+            if url.path.startswith('/admin/api/'):
+                return self.shopify(method, url, raw)
+            return self.site(url)
+
+        def site(self, url):
+            time.sleep(jitter(site_latency))
+            if url.path in site.collections:
+                pages = site.collections[url.path]
+                page = int(parse_qs(url.query).get('page', ['1'])[0])
+                stats['site collection 200'] += 1
+                # Past the last page Shopify answers an empty grid
+                return self.send(200, pages[page - 1] if page <= len(pages) else site.head.encode() + site.tail.encode())
+            if url.path in site.sitemaps:
+                stats['site sitemap 200'] += 1
+                return self.send(200, site.sitemaps[url.path], 'application/xml')
+            if url.path in site.products:
+                etag, content = site.products[url.path]
+                if self.headers.get('If-None-Match') == f'"{etag}"':
+                    stats['site product 304'] += 1
+                    return self.send(304, b'', headers={'ETag': f'"{etag}"'})
+                stats['site product 200'] += 1
+                return self.send(200, content, headers={'ETag': f'"{etag}"'})
+            stats['site 404'] += 1
+            self.send(404, b'Not Found')
+
+        def shopify(self, method, url, raw):
+            path = url.path.split('/', 4)[4]
+            stats[f'shopify {method} {re.sub(r"/[0-9]+", "/<id>", path)}'] += 1
+            if access_token and self.headers.get('X-Shopify-Access-Token') != access_token:
+                stats['shopify 401'] += 1
+                return self.send(401, b'{"errors":"[API] Invalid API key or access token (unrecognized login or '
+                                      b'wrong password)"}', 'application/json')
+            time.sleep(jitter(shopify_latency))
+            if not shopify.take():
+                stats['shopify 429'] += 1
+                return self.send(429, b'{"errors":"Exceeded 2 calls per second for api client. Reduce request rates '
+                                      b'to resume uninterrupted service."}', 'application/json',
+                                 {'Retry-After': '1.0', 'X-Shopify-Shop-Api-Call-Limit': shopify.call_limit()})
+            status, payload = shopify.handle(method, path, parse_qs(url.query), json.loads(raw) if raw else {})
+            self.send(status, json.dumps(payload).encode(), 'application/json; charset=utf-8',
+                      {'X-Shopify-Shop-Api-Call-Limit': shopify.call_limit(),
+                       'X-Request-Id': hashlib.md5(os.urandom(8)).hexdigest()})
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--site-latency', type=float, default=0.05, help='mean seconds per store page')
+    parser.add_argument('--shopify-latency', type=float, default=0.15, help='mean seconds per Shopify call')
+    parser.add_argument('--shopify-bucket', type=int, default=40)
+    parser.add_argument('--shopify-leak-rate', type=float, default=2.0)
+    parser.add_argument('--page-size', type=int, default=48, help='products per generated collection page')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--access-token', help='answer Shopify calls without this token with 401')
+    args = parser.parse_args()
+
+    stats = Counter()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), None)
+    site = Site(f'http://127.0.0.1:{server.server_address[1]}', args.page_size)
+    shopify = FakeShopify(args.shopify_bucket, args.shopify_leak_rate)
+    server.RequestHandlerClass = make_handler(site, shopify, stats, args.site_latency, args.shopify_latency, args.seed,
+                                              args.access_token)
+    server.daemon_threads = True
+    print(f"listening on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+# How long a cached read stays valid, and how many reads are kept at most
+READ_CACHE_TTL = float(os.environ.get('READ_CACHE_TTL', 60))
+READ_CACHE_SIZE = int(os.environ.get('READ_CACHE_SIZE', 256))
+
+
+def body_etag(body):
+    """The validator of a response body: the same content gets the same ETag, in any process."""
+    return hashlib.sha1(body.encode()).hexdigest()
+
+
+class CacheEntry:
+    def __init__(self, key, value, tags, expires):
+        self.key = key
+        self.value = value
+        self.tags = set(tags)
+        self.expires = expires
+        self.etag = body_etag(value)
+
+
+class ReadCache:
+    """In-process LRU cache with a TTL, invalidated by tag (brand, product id, ...)."""
+
+    def __init__(self, ttl=READ_CACHE_TTL, maxsize=READ_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped on every invalidation so a read that started before a write
+        # cannot put its (now stale) result into the cache afterwards
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, tags=(), generation=None):
+        """Store value; skipped if an invalidation happened since `generation`."""
+        entry = CacheEntry(key, value, tags, time.monotonic() + self.ttl)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return entry
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying one of `tags`, or everything when none are given."""
+        with self.lock:
+            self.generation += 1
+            if not tags:
+                self.entries.clear()
+                return
+            for key in [key for key, entry in self.entries.items() if entry.tags & set(tags)]:
+                del self.entries[key]
+
+
+read_cache = ReadCache()
@@ -0,0 +1,160 @@
+"""Export and import the product catalog as compressed NDJSON, one product per line.
+
+    python catalog_dump.py export                          # every brand -> dumps/<brand>.ndjson.gz
+    python catalog_dump.py export --brand Nike --out-dir backups
+    python catalog_dump.py import dumps/*.ndjson.gz
+    python catalog_dump.py import admin.nike.json          # the old array exports work too
+
+Documents are streamed in both directions, so memory does not grow with the
+catalog: exports write each brand from its own cursor on a pool of threads,
+and imports read one document at a time (the old pretty-printed arrays are
+decoded incrementally) into batched bulk upserts that keep each product's _id.
+An interrupted import resumes after the last flushed batch when run again;
+--restart starts the file over.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from bson import json_util
+from dotenv import load_dotenv
+
+from logs import configure_logging
+from migrate_products import migration_upsert
+from storage import BulkWriter, db, ensure_product_indexes, products_collection
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Brands exported at the same time
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 3))
+
+# Import progress per file, so an interrupted import can pick up where it stopped
+imports_collection = db['catalog_imports']
+
+CHUNK_SIZE = 64 * 1024
+
+
+def open_text(path, mode='rt'):
+    return gzip.open(path, mode, encoding='utf-8') if path.endswith('.gz') else open(path, mode, encoding='utf-8')
+
+
+def export_brand(brand, out_dir):
+    """Stream one brand to <out_dir>/<brand>.ndjson.gz; returns (path, products written)."""
+    path = os.path.join(out_dir, f"{brand.lower()}.ndjson.gz")
+    written = 0
+    # Written next to the target and renamed, so a failed export never replaces a good one
+    with gzip.open(path + '.part', 'wt', encoding='utf-8') as f:
+        for document in products_collection.find({'brand': brand}).sort('_id', 1):
+            f.write(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n')
+            written += 1
+    os.replace(path + '.part', path)
+    logger.info('Exported %s', brand, extra={'path': path, 'products': written})
+    return path, written
+
+
+def export_catalog(brands=None, out_dir='dumps', workers=EXPORT_WORKERS):
+    os.makedirs(out_dir, exist_ok=True)
+    brands = brands or sorted(b for b in products_collection.distinct('brand') if b)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda brand: export_brand(brand, out_dir), brands))
+
+
+def iter_json_array(f):
+    """Documents of a JSON array (an old admin.*.json export), decoded one at a time."""
+    decoder = json.JSONDecoder(object_hook=json_util.object_hook)
+    buffer, position, eof = '', 0, False
+    while True:
+        # Skip to the start of the next element
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            document, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                if buffer[position:].strip():
+                    raise
+                return
+            chunk = f.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield document
+        position = end
+
+
+def iter_documents(path):
+    """Products in an NDJSON (optionally gzipped) or JSON array file, streamed."""
+    with open_text(path) as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == '[':
+            yield from iter_json_array(f)
+            return
+        line = first + f.readline()
+        while line:
+            if line.strip():
+                yield json_util.loads(line)
+            line = f.readline()
+
+
+def import_file(path, restart=False):
+    """Upsert every product in `path`. Returns the number imported by this run."""
+    stat = os.stat(path)
+    # The same file (name, size and modification time) resumes; a changed one starts over
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    progress = None if restart else imports_collection.find_one({'_id': key})
+    if progress and progress.get('finished'):
+        logger.info('%s was already imported', path)
+        return 0
+    skip = progress['done'] if progress else 0
+    queued = 0
+
+    def checkpoint():
+        # Called after each bulk write: everything queued so far is in Mongo
+        imports_collection.update_one({'_id': key}, {'$set': {
+            'path': path, 'done': skip + queued, 'updated_at': datetime.now(timezone.utc),
+        }}, upsert=True)
+
+    with BulkWriter(on_flush=checkpoint) as writer:
+        for i, document in enumerate(iter_documents(path)):
+            if i < skip:
+                continue
+            writer.add(products_collection, migration_upsert(document))
+            queued += 1
+    imports_collection.update_one({'_id': key}, {'$set': {'finished': True, 'done': skip + queued}}, upsert=True)
+    logger.info('Imported %s', path, extra=dict(writer.stats, resumed_after=skip))
+    return queued
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write each brand to <out-dir>/<brand>.ndjson.gz')
+    export.add_argument('--brand', action='append', help='only this brand (repeatable)')
+    export.add_argument('--out-dir', default='dumps')
+    export.add_argument('--workers', type=int, default=EXPORT_WORKERS, help='brands exported at the same time')
+    load = commands.add_parser('import', help='upsert products from NDJSON or JSON array files')
+    load.add_argument('files', nargs='+')
+    load.add_argument('--restart', action='store_true', help='ignore the progress of earlier runs')
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.command == 'export':
+        export_catalog(args.brand, args.out_dir, args.workers)
+    else:
+        ensure_product_indexes()
+        for path in args.files:
+            import_file(path, args.restart)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Live product changes for the admin UI, whoever made them.
+
+The web process tails a change stream on the products collection (a polling
+loop on updated_at when Mongo is a standalone server without change streams)
+and sends each brand's changes to the clients in its room, batched per
+CHANGE_FEED_WINDOW:
+
+    'catalog' {"brand": ..., "changes": [{"op": "upsert", "_id": ..., "product": {<grid fields>}},
+                                         {"op": "delete", "_id": ...}]}
+
+A client joins a brand's room with 'watch_catalog' {"brand": ...} after
+loading the brand's grid and applies the changes to it in place. Every change
+also drops the product and its brand from the read cache, so writes made by
+the worker or the command line tools are not served stale.
+"""
+import logging
+import os
+
+import eventlet
+from dotenv import load_dotenv
+from pymongo.errors import OperationFailure, PyMongoError
+
+from metrics import count, timer
+from storage import GRID_PROJECTION, products_collection
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Run the feed in the web process
+CHANGE_FEED = os.environ.get('CHANGE_FEED', '1').lower() in ('1', 'true', 'yes')
+# Changes of a brand are sent together at most once per window (seconds)
+CHANGE_FEED_WINDOW = float(os.environ.get('CHANGE_FEED_WINDOW', 1))
+# Seconds between polls when change streams are not available
+CHANGE_FEED_POLL_INTERVAL = float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 5))
+# Seconds before the change stream is opened again after an error
+CHANGE_FEED_RETRY_INTERVAL = float(os.environ.get('CHANGE_FEED_RETRY_INTERVAL', 10))
+
+# Mongo's error when $changeStream is run on a standalone server
+CHANGE_STREAMS_UNSUPPORTED = 40573
+POLL_BATCH_SIZE = 1000
+
+# Changes the grid cannot show are left out: Shopify bookkeeping (shopify.*) is
+# most of the update traffic once products are synced
+CHANGE_PIPELINE = [
+    {'$match': {'$or': [
+        {'operationType': {'$in': ['insert', 'replace', 'delete']}},
+        {'operationType': 'update', '$expr': {'$anyElementTrue': [{'$map': {
+            'input': {'$objectToArray': '$updateDescription.updatedFields'},
+            'in': {'$ne': [{'$substrBytes': ['$$this.k', 0, 7]}, 'shopify']},
+        }}]}},
+    ]}},
+    # The grid's fields only (the _id is the resume token and stays)
+    {'$project': {
+        'operationType': 1,
+        'documentKey': 1,
+        **{f'fullDocument.{field}': 1 for field in GRID_PROJECTION if field != 'Images'},
+        'fullDocument.Images': {'$slice': ['$fullDocument.Images', 1]},
+    }},
+]
+
+
+def catalog_room(brand):
+    return f"catalog:{brand}"
+
+
+class CatalogStream:
+    """Buffers changes per brand and sends each brand's batch to its room.
+
+    A product changed several times within a window is sent once, as it was
+    last seen.
+    """
+
+    def __init__(self, emit, invalidate=None, window=CHANGE_FEED_WINDOW):
+        self.emit = emit
+        self.invalidate = invalidate
+        self.window = window
+        self.buffer = {}  # brand -> {_id: change}
+        self.brands = None  # every brand, loaded on the first delete
+        self.timer = None
+        self.resume_token = None  # where a reopened change stream carries on
+
+    def upsert(self, product):
+        product = dict(product, _id=str(product['_id']))
+        product.pop('updated_at', None)
+        if self.brands is not None:
+            self.brands.add(product.get('brand'))
+        self.add(product.get('brand'), {'op': 'upsert', '_id': product['_id'], 'product': product})
+
+    def delete(self, _id):
+        # A deleted document no longer says which brand it was: every room hears of it
+        if self.brands is None:
+            self.brands = set(products_collection.distinct('brand'))
+        for brand in self.brands:
+            self.add(brand, {'op': 'delete', '_id': str(_id)})
+
+    def add(self, brand, change):
+        self.buffer.setdefault(brand, {})[change['_id']] = change
+        if self.timer is None:
+            self.timer = eventlet.spawn_after(self.window, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        buffer, self.buffer = self.buffer, {}
+        if self.invalidate and buffer:
+            self.invalidate(*{_id for changes in buffer.values() for _id in changes}, *buffer)
+        for brand, changes in buffer.items():
+            with timer('emit', event='catalog'):
+                self.emit('catalog', {'brand': brand, 'changes': list(changes.values())}, to=catalog_room(brand))
+            count('emits', event='catalog')
+            count('catalog_changes', len(changes))
+
+
+def tail_change_stream(stream):
+    """Follow the change stream, from where the last one stopped, until it fails."""
+    with products_collection.watch(CHANGE_PIPELINE, full_document='updateLookup',
+                                   resume_after=stream.resume_token) as changes:
+        logger.info('Following product changes through a change stream')
+        for change in changes:
+            stream.resume_token = changes.resume_token
+            if change['operationType'] == 'delete':
+                stream.delete(change['documentKey']['_id'])
+            elif change.get('fullDocument'):
+                # Updated and deleted again before the lookup: the delete follows
+                stream.upsert(dict(change['fullDocument'], _id=change['documentKey']['_id']))
+
+
+def poll_changes(stream, interval=CHANGE_FEED_POLL_INTERVAL):
+    """Poll for products with a newer updated_at, forever. Scrapes, revisits and
+    admin edits all set it; deletions are not seen this way. Products are read
+    in (updated_at, _id) order from just after the last one sent."""
+    projection = dict(GRID_PROJECTION, updated_at=1)
+    order = [('updated_at', 1), ('_id', 1)]
+    position = None  # (updated_at, _id) of the last product sent, or there when the feed started
+    started = False
+    logger.info('Polling for product changes every %ss (no change streams on this server)', interval)
+    while True:
+        try:
+            if not started:
+                latest = products_collection.find_one({'updated_at': {'$ne': None}}, {'updated_at': 1},
+                                                      sort=[(field, -1) for field, _ in order])
+                position, started = latest and (latest['updated_at'], latest['_id']), True
+            while started:
+                if position:
+                    since, last_id = position
+                    query = {'$or': [{'updated_at': {'$gt': since}}, {'updated_at': since, '_id': {'$gt': last_id}}]}
+                else:
+                    query = {'updated_at': {'$ne': None}}
+                products = list(products_collection.find(query, projection).sort(order).limit(POLL_BATCH_SIZE))
+                for product in products:
+                    position = (product['updated_at'], product['_id'])
+                    stream.upsert(product)
+                if len(products) < POLL_BATCH_SIZE:
+                    break
+        except PyMongoError as e:
+            logger.warning('Polling for product changes failed: %s', e)
+        eventlet.sleep(interval)
+
+
+def run_change_feed(emit, invalidate=None):
+    """Send product changes to the catalog rooms forever (a background task of the web process)."""
+    stream = CatalogStream(emit, invalidate)
+    while True:
+        try:
+            tail_change_stream(stream)
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                break
+            logger.warning('Product change stream failed: %s', e)
+            if e.has_error_label('NonResumableChangeStreamError'):
+                # The token is too old to resume from: start from now
+                stream.resume_token = None
+        except PyMongoError as e:
+            logger.warning('Product change stream failed: %s', e)
+        eventlet.sleep(CHANGE_FEED_RETRY_INTERVAL)
+    # A standalone server: fall back to polling, which retries on its own
+    poll_changes(stream)
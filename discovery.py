@@ -0,0 +1,104 @@
+"""Find the product pages of a brand collection.
+
+Every page of the collection is read: the first page's pagination links say
+which pages exist and those are fetched together, as are any further pages
+they link to. Products linked from several pages (or with a ?variant= query)
+are listed once. Discovery also says whether every page was read, since a
+product missing from a partial read has not necessarily left the store.
+
+The store's sitemap.xml (and its sitemap_products_*.xml children) gives the
+<lastmod> of each product, which the scraper compares with the one recorded
+at the product's last scrape to leave unchanged pages alone.
+"""
+import logging
+import os
+from urllib.parse import urljoin, urlparse
+from xml.etree.ElementTree import ParseError
+
+import requests
+from dotenv import load_dotenv
+
+from fetcher import fetch, fetch_all
+from parsers import parse_collection_links, parse_collection_pages, parse_sitemap
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Read the store's sitemap for product <lastmod> dates
+SITEMAP_DISCOVERY = os.environ.get('SITEMAP_DISCOVERY', '1').lower() in ('1', 'true', 'yes')
+# Collection pages followed at most (guards against pagination that never ends)
+COLLECTION_MAX_PAGES = int(os.environ.get('COLLECTION_MAX_PAGES', 100))
+
+
+def product_handle(url):
+    # /products/<handle> and /collections/<brand>/products/<handle> are the same product
+    path = urlparse(url).path.rstrip('/')
+    return path.rsplit('/products/', 1)[-1] if '/products/' in path else path
+
+
+def _load(url):
+    response = fetch(url)
+    response.raise_for_status()
+    return response.content
+
+
+def collection_links(collection_url, max_pages=COLLECTION_MAX_PAGES):
+    """(product links ({'name', 'link'}) of every page of a collection in page
+    order, whether every page was read)."""
+    content = _load(collection_url)
+    pages = {1: parse_collection_links(content)}
+    known = parse_collection_pages(content)
+    failed = 0
+    while True:
+        todo = {f"{collection_url}?page={page}": page for page in sorted(known)
+                if page not in pages and page <= max_pages}
+        if not todo:
+            break
+        for url, content in fetch_all(todo, _load):
+            # A page that failed is logged by fetch_all and left out
+            pages[todo[url]] = parse_collection_links(content) if content else []
+            if content:
+                known |= parse_collection_pages(content)
+            else:
+                failed += 1
+    complete = not failed and max(known, default=1) <= max_pages
+
+    links, seen = [], set()
+    for page in sorted(pages):
+        for link in pages[page]:
+            handle = product_handle(link['link'])
+            if handle not in seen:
+                seen.add(handle)
+                links.append(link)
+    logger.info('Read collection', extra={'url': collection_url, 'pages': len(pages), 'failed_pages': failed,
+                                          'products': len(links), 'complete': complete})
+    return links, complete
+
+
+def sitemap_lastmods(base_url):
+    """{product handle: lastmod} from the store's sitemaps; {} when it has none."""
+    sitemap_url = f"{base_url}/sitemap.xml"
+    try:
+        sitemaps, entries = parse_sitemap(_load(sitemap_url))
+    except (requests.exceptions.RequestException, ParseError) as e:
+        logger.warning('Could not read the sitemap, every product will be visited: %s', e, extra={'url': sitemap_url})
+        return {}
+
+    for url, content in fetch_all([s for s in sitemaps if 'sitemap_products' in s], _load):
+        try:
+            entries += parse_sitemap(content)[1] if content else []
+        except ParseError as e:
+            # Products of this sitemap are visited without a lastmod
+            logger.warning('Could not parse sitemap: %s', e, extra={'url': url})
+    return {product_handle(loc): lastmod for loc, lastmod in entries if '/products/' in loc and lastmod}
+
+
+def discover_products(base_url, collection_url, use_sitemap=None):
+    """([(url, name, lastmod)] of every product in the collection, whether every
+    collection page was read); lastmod is None when the sitemap does not list
+    the product (or is not used)."""
+    links, complete = collection_links(collection_url)
+    lastmods = sitemap_lastmods(base_url) if (SITEMAP_DISCOVERY if use_sitemap is None else use_sitemap) else {}
+    return [(urljoin(base_url, link['link']), link['name'], lastmods.get(product_handle(link['link'])))
+            for link in links], complete
@@ -0,0 +1,132 @@
+import logging
+import os
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+import eventlet
+import requests
+from eventlet.queue import Queue
+from eventlet.semaphore import Semaphore
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry # type: ignore
+from dotenv import load_dotenv
+
+from metrics import count, timer
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# How many product pages are fetched at the same time during a scrape
+SCRAPE_WORKERS = int(os.environ.get('SCRAPE_WORKERS', 8))
+# Max requests per second sent to a single host (0 disables the limit)
+SCRAPE_RATE_PER_HOST = float(os.environ.get('SCRAPE_RATE_PER_HOST', 4))
+# Keep-alive connections kept open per host by the shared session
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', SCRAPE_WORKERS))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+}
+
+_session = None
+# Requests this process has sent to each host (the revisit scheduler's budget is taken from it)
+requests_sent = Counter()
+
+
+def get_session(pool_size=None):
+    """Return the process-wide session shared by every scrape request.
+
+    The adapter keeps up to `pool_size` keep-alive connections per host and
+    blocks instead of opening throwaway ones when they are all busy.
+    """
+    global _session
+    if _session is None:
+        pool_size = pool_size or HTTP_POOL_SIZE
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              pool_block=True, max_retries=retries)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(headers)
+        _session = session
+    return _session
+
+
+def fetch(url, **kwargs):
+    """GET a page once over the shared session."""
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    requests_sent[urlparse(url).netloc] += 1
+    # With stream=True this times the response headers; the body is read by the caller
+    with timer('fetch'):
+        response = get_session().get(url, **kwargs)
+    count('fetch_responses', status=response.status_code)
+    return response
+
+
+class HostRateLimiter:
+    """Spaces out requests so each host sees at most `rate` requests per second."""
+
+    def __init__(self, rate=SCRAPE_RATE_PER_HOST):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = {}  # host -> earliest time the next request may start
+        self.lock = Semaphore()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            eventlet.sleep(slot - now)
+
+
+# One limiter for every page fetch, so concurrent scrapes and revisits share the per-host rate
+page_limiter = HostRateLimiter()
+
+
+def fetch_all(urls, worker, workers=None, limiter=None):
+    """Run worker(url) for every url on a bounded pool of green threads.
+
+    Yields (url, result) pairs in the order they finish, so callers can store
+    and emit each product as soon as it is ready. A worker that raises yields
+    a None result. Requests are spaced out by `limiter` (page_limiter by default).
+    """
+    urls = list(urls)
+    limiter = limiter or page_limiter
+    pool = eventlet.GreenPool(workers or SCRAPE_WORKERS)
+    results = Queue()
+
+    def run(url):
+        try:
+            limiter.wait(url)
+            results.put((url, worker(url)))
+        except Exception as e:
+            logger.warning('Fetch failed: %s', e, extra={'url': url})
+            results.put((url, None))
+
+    def feed():
+        # spawn_n blocks while the pool is full, so feed it from its own
+        # green thread and keep this generator free to yield results
+        for url in urls:
+            pool.spawn_n(run, url)
+
+    eventlet.spawn_n(feed)
+    for _ in urls:
+        yield results.get()
+
+
+def conditional_headers(validator):
+    """Build If-None-Match / If-Modified-Since headers from a stored validator."""
+    conditional = {}
+    if validator:
+        if validator.get('etag'):
+            conditional['If-None-Match'] = validator['etag']
+        if validator.get('last_modified'):
+            conditional['If-Modified-Since'] = validator['last_modified']
+    return conditional
@@ -0,0 +1,300 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import eventlet
+import requests
+from dotenv import load_dotenv
+from eventlet import tpool
+
+from fetcher import HostRateLimiter, conditional_headers, fetch, fetch_all
+from metrics import count, timed, timer
+from shopify_client import graphql, user_errors
+from storage import db
+
+try:
+    from PIL import Image
+except ImportError:  # resized variants are skipped without Pillow
+    Image = None
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Uploaded and mirrored images live here, named by the SHA-256 of their content
+IMAGE_STORE = os.environ.get('IMAGE_STORE', 'static/uploads')
+# Widths of the web-sized copies made of every stored image
+IMAGE_VARIANT_WIDTHS = tuple(int(w) for w in os.environ.get('IMAGE_VARIANT_WIDTHS', '400,1200').split(','))
+# Largest upload accepted
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 20 * 1024 * 1024))
+# Mirror scraped product images into the store while scraping (off by default)
+MIRROR_IMAGES = os.environ.get('MIRROR_IMAGES', '').lower() in ('1', 'true', 'yes')
+# Products whose images are mirrored at the same time, and image requests per second per CDN host
+IMAGE_MIRROR_WORKERS = int(os.environ.get('IMAGE_MIRROR_WORKERS', 4))
+IMAGE_MIRROR_RATE_PER_HOST = float(os.environ.get('IMAGE_MIRROR_RATE_PER_HOST', 8))
+# A mirrored image is only revalidated with its source after this many seconds
+IMAGE_REVALIDATE_AFTER = float(os.environ.get('IMAGE_REVALIDATE_AFTER', 24 * 3600))
+# Seconds to wait for Shopify to process an uploaded file before using its staged URL
+SHOPIFY_FILE_READY_TIMEOUT = float(os.environ.get('SHOPIFY_FILE_READY_TIMEOUT', 10))
+
+images_collection = db['images']
+# Remote URL -> stored image, with the ETag / Last-Modified to revalidate it
+image_sources_collection = db['image_sources']
+
+CONTENT_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.gif': 'image/gif',
+                 '.webp': 'image/webp'}
+CHUNK_SIZE = 64 * 1024
+
+STAGED_UPLOAD_MUTATION = """
+mutation stage($input: [StagedUploadInput!]!) {
+  stagedUploadsCreate(input: $input) {
+    stagedTargets { url resourceUrl parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
+
+FILE_CREATE_MUTATION = """
+mutation create($files: [FileCreateInput!]!) {
+  fileCreate(files: $files) {
+    files { id }
+    userErrors { field message }
+  }
+}
+"""
+
+FILE_QUERY = """
+query file($id: ID!) {
+  node(id: $id) { ... on MediaImage { fileStatus image { url } } }
+}
+"""
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def ensure_image_indexes():
+    images_collection.create_index('filename')
+
+
+def image_path(filename):
+    return os.path.join(IMAGE_STORE, filename)
+
+
+def image_url(filename):
+    return f'/uploads/{filename}'
+
+
+def is_content_addressed(filename):
+    """True for files stored by hash ("<sha256>.png", "<sha256>-400.png")."""
+    return re.match(r'^[0-9a-f]{64}(-\d+)?\.\w+$', filename) is not None
+
+
+def _extension(filename):
+    ext = os.path.splitext(filename or '')[1].lower()
+    return '.jpg' if ext == '.jpeg' else ext
+
+
+def store_image(stream, filename):
+    """Save an image stream under its content hash. Returns the image document;
+    a file that is already stored is not written again."""
+    os.makedirs(IMAGE_STORE, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    # Hash while copying to a temp file in the store, so nothing is held in memory
+    with tempfile.NamedTemporaryFile(dir=IMAGE_STORE, delete=False) as tmp:
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise ImageTooLarge(f"Images are limited to {IMAGE_MAX_BYTES} bytes")
+                digest.update(chunk)
+                tmp.write(chunk)
+        except Exception:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    sha = digest.hexdigest()
+
+    existing = images_collection.find_one({'_id': sha})
+    if existing and os.path.exists(image_path(existing['filename'])):
+        os.remove(tmp.name)
+        count('images_stored', new='false')
+        return existing
+
+    ext = _extension(filename)
+    document = {
+        '_id': sha,
+        'filename': f'{sha}{ext}',
+        'content_type': CONTENT_TYPES.get(ext, 'application/octet-stream'),
+        'size': size,
+        'variants': {},
+        'created_at': datetime.now(timezone.utc),
+    }
+    os.replace(tmp.name, image_path(document['filename']))
+    images_collection.update_one({'_id': sha}, {'$set': document}, upsert=True)
+    count('images_stored', new='true')
+    schedule_variants(sha)
+    return document
+
+
+def store_file(path):
+    """Bring a file already on disk (e.g. an upload saved by name) into the store."""
+    with open(path, 'rb') as f:
+        return store_image(f, path)
+
+
+@timed('image_encode')
+def make_variants(sha):
+    """Write the web-sized copies of one image. Runs on a real OS thread."""
+    document = images_collection.find_one({'_id': sha})
+    if Image is None or document is None:
+        return
+    variants = {}
+    with Image.open(image_path(document['filename'])) as original:
+        ext = _extension(document['filename'])
+        for width in IMAGE_VARIANT_WIDTHS:
+            if width >= original.width:
+                continue
+            copy = original.copy()
+            copy.thumbnail((width, width * original.height // original.width))
+            filename = f'{sha}-{width}{ext}'
+            copy.save(image_path(filename), optimize=True)
+            if os.path.getsize(image_path(filename)) >= document['size']:
+                # No smaller than the original (already compressed well): serve that instead
+                os.remove(image_path(filename))
+                continue
+            variants[str(width)] = filename
+        dimensions = {'width': original.width, 'height': original.height}
+    images_collection.update_one({'_id': sha}, {'$set': dict(dimensions, variants=variants)})
+
+
+def schedule_variants(sha):
+    # Resizing is CPU bound: run it on eventlet's OS thread pool, off the hub
+    eventlet.spawn_n(tpool.execute, make_variants, sha)
+
+
+def variant_filename(document, width):
+    """The smallest stored copy at least `width` wide, or the original."""
+    for candidate in sorted(document.get('variants', {}), key=int):
+        if int(candidate) >= width:
+            return document['variants'][candidate]
+    return document['filename']
+
+
+def stage_to_shopify(document):
+    """Send a stored image to Shopify through a staged upload and register it as
+    a file. Returns a URL Shopify can fetch the image from."""
+    path = image_path(document['filename'])
+    target = user_errors(graphql(STAGED_UPLOAD_MUTATION, {'input': [{
+        'resource': 'IMAGE',
+        'filename': document['filename'],
+        'mimeType': document['content_type'],
+        'fileSize': str(document['size']),
+        'httpMethod': 'POST',
+    }]})['stagedUploadsCreate'])['stagedTargets'][0]
+    parameters = {p['name']: p['value'] for p in target['parameters']}
+    with open(path, 'rb') as f, timer('image_upload'):
+        response = requests.post(target['url'], data=parameters, files={'file': f}, timeout=300)
+    response.raise_for_status()
+
+    created = user_errors(graphql(FILE_CREATE_MUTATION, {'files': [{
+        'originalSource': target['resourceUrl'], 'contentType': 'IMAGE',
+    }]})['fileCreate'])['files'][0]
+    # The file's permanent CDN URL appears once Shopify has processed it
+    deadline = time.monotonic() + SHOPIFY_FILE_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        node = graphql(FILE_QUERY, {'id': created['id']})['node'] or {}
+        if node.get('fileStatus') == 'READY' and node.get('image'):
+            images_collection.update_one({'_id': document['_id']}, {'$set': {
+                'shopify': {'file_id': created['id'], 'url': node['image']['url']},
+            }})
+            return node['image']['url']
+        if node.get('fileStatus') == 'FAILED':
+            break
+        time.sleep(1)
+    # Not ready yet: the staged URL works for the product about to be saved
+    images_collection.update_one({'_id': document['_id']}, {'$set': {'shopify': {'file_id': created['id']}}})
+    return target['resourceUrl']
+
+
+def shopify_image_src(path, upload=True):
+    """The URL to give Shopify for a local image: each distinct image is uploaded once.
+    With upload=False only an image already on Shopify has one (None otherwise)."""
+    # Stored images are found by name; files saved by their original name are hashed first
+    document = images_collection.find_one({'filename': os.path.basename(path)}) or store_file(path)
+    shopify_file = document.get('shopify') or {}
+    if shopify_file.get('url'):
+        return shopify_file['url']
+    if shopify_file.get('file_id'):
+        # Uploaded earlier but was still processing then
+        node = graphql(FILE_QUERY, {'id': shopify_file['file_id']})['node'] or {}
+        if node.get('fileStatus') == 'READY' and node.get('image'):
+            images_collection.update_one({'_id': document['_id']}, {'$set': {'shopify.url': node['image']['url']}})
+            return node['image']['url']
+    return stage_to_shopify(document) if upload else None
+
+
+# One limiter for every mirror task, so concurrent products share the per-host budget
+mirror_limiter = HostRateLimiter(IMAGE_MIRROR_RATE_PER_HOST)
+
+
+def mirror_image(url):
+    """Local URL of a remote image, downloading it only when the source changed."""
+    source = image_sources_collection.find_one({'_id': url})
+    now = datetime.now(timezone.utc)
+    if source and (now - source['checked_at'].replace(tzinfo=timezone.utc)).total_seconds() < IMAGE_REVALIDATE_AFTER:
+        return image_url(source['filename'])
+
+    fetch_url = f'https:{url}' if url.startswith('//') else url
+    response = fetch(fetch_url, headers=conditional_headers(source), stream=True)
+    try:
+        if response.status_code == 304:
+            image_sources_collection.update_one({'_id': url}, {'$set': {'checked_at': now}})
+            return image_url(source['filename'])
+        response.raise_for_status()
+        response.raw.decode_content = True
+        # Identical images under different URLs (colourways, variants) are stored once
+        image = store_image(response.raw, os.path.basename(response.url.split('?')[0]))
+    finally:
+        response.close()
+    image_sources_collection.update_one({'_id': url}, {'$set': {
+        'filename': image['filename'],
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'checked_at': now,
+    }}, upsert=True)
+    return image_url(image['filename'])
+
+
+def mirror_images(urls):
+    """Mirror a product's images concurrently; images that fail keep their remote URL."""
+    local = dict(fetch_all(set(urls), mirror_image, limiter=mirror_limiter))
+    return [local.get(url) or url for url in urls]
+
+
+class ImageMirror:
+    """Background stage of a scrape: mirror a product's images, then hand the
+    product on with local image URLs. wait() returns once everything submitted is done."""
+
+    def __init__(self, workers=IMAGE_MIRROR_WORKERS):
+        self.pool = eventlet.GreenPool(workers)
+
+    def submit(self, images, callback):
+        self.pool.spawn_n(self._run, images, callback)
+
+    def _run(self, images, callback):
+        try:
+            local = mirror_images(images)
+        except Exception as e:
+            logger.warning('Image mirror failed: %s', e)
+            local = images
+        callback(local)
+
+    def wait(self):
+        self.pool.waitall()
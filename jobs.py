@@ -0,0 +1,148 @@
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+
+import eventlet
+from pymongo import ReturnDocument
+from dotenv import load_dotenv
+
+from progress import ProgressStream
+from scraper import run_scrape
+from storage import db
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Scrape jobs one worker process runs at the same time (one brand each)
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 3))
+# Seconds an idle worker waits before looking for queued jobs again
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2))
+# A running job whose worker has not checked in for this long is picked up again
+JOB_STALE_AFTER = float(os.environ.get('JOB_STALE_AFTER', 60))
+# Lets workers in another process emit Socket.IO events (e.g. redis://...);
+# without it the page falls back to polling GET /jobs/<id>
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+jobs_collection = db['scrape_jobs']
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+def ensure_job_indexes():
+    jobs_collection.create_index([('state', 1), ('created_at', 1)])
+    jobs_collection.create_index([('params.brand', 1), ('state', 1)])
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def enqueue_scrape(url, brand, mode=None):
+    """Queue a scrape of one brand. Returns (job_id, created); a brand that is
+    already queued or running returns the existing job instead."""
+    existing = jobs_collection.find_one({'params.brand': brand, 'state': {'$in': [JOB_QUEUED, JOB_RUNNING]}})
+    if existing:
+        return existing['_id'], False
+    job = {
+        'type': 'scrape',
+        'params': {'url': url, 'brand': brand, 'mode': mode},
+        'state': JOB_QUEUED,
+        'created_at': _now(),
+        'attempts': 0,
+        'progress': {'done': 0, 'updated': 0, 'unchanged': 0, 'failed': 0},
+        'checkpoint': {'done_urls': []},
+    }
+    return jobs_collection.insert_one(job).inserted_id, True
+
+
+def claim_job(worker_id):
+    """Take the oldest queued job, or a running one whose worker went away."""
+    now = _now()
+    return jobs_collection.find_one_and_update(
+        {'$or': [
+            {'state': JOB_QUEUED},
+            {'state': JOB_RUNNING, 'heartbeat_at': {'$lt': now - timedelta(seconds=JOB_STALE_AFTER)}},
+        ]},
+        {'$set': {'state': JOB_RUNNING, 'worker': worker_id, 'heartbeat_at': now},
+         '$min': {'started_at': now},
+         '$inc': {'attempts': 1}},
+        sort=[('created_at', 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def public_job(job):
+    """A job document as the /jobs API returns it (without the checkpoint URL list)."""
+    job = {key: value for key, value in job.items() if key != 'checkpoint'}
+    job['_id'] = str(job['_id'])
+    return job
+
+
+def run_job(job, worker_id, emit=None, on_write=None):
+    # Writes are scoped to this worker so a job reclaimed elsewhere is not clobbered
+    owned = {'_id': job['_id'], 'worker': worker_id}
+
+    def heartbeat():
+        while True:
+            eventlet.sleep(JOB_STALE_AFTER / 3)
+            jobs_collection.update_one(owned, {'$set': {'heartbeat_at': _now()}})
+
+    def checkpoint(results):
+        counts = {}
+        for _, status in results:
+            counts[f'progress.{status}'] = counts.get(f'progress.{status}', 0) + 1
+        counts['progress.done'] = len(results)
+        jobs_collection.update_one(owned, {
+            '$push': {'checkpoint.done_urls': {'$each': [url for url, _ in results]}},
+            '$inc': counts,
+            '$set': {'heartbeat_at': _now()},
+        })
+
+    params = job['params']
+    # Progress goes to the job's room, batched per window
+    emit = ProgressStream(emit, job['_id']) if emit else None
+    beat = eventlet.spawn(heartbeat)
+    try:
+        run_scrape(params['url'], params['brand'], params.get('mode'), emit=emit,
+                   skip_urls=set(job['checkpoint']['done_urls']), checkpoint=checkpoint,
+                   on_flush=on_write and (lambda: on_write(params['brand'])))
+        jobs_collection.update_one(owned, {'$set': {'state': JOB_DONE, 'finished_at': _now()}})
+    except Exception as e:
+        logger.exception('Scrape job %s failed', job['_id'], extra={'brand': params['brand']})
+        jobs_collection.update_one(owned, {'$set': {'state': JOB_FAILED, 'finished_at': _now(), 'error': str(e)}})
+        if emit:
+            emit('update', {'message': f"Scrape of {params['brand']} failed: {e}"})
+    finally:
+        beat.kill()
+        if emit:
+            emit.flush()
+
+
+def socket_emitter():
+    """emit(event, payload) for a worker outside the web process, if a message queue is configured."""
+    if not SOCKETIO_MESSAGE_QUEUE:
+        return None
+    from flask_socketio import SocketIO
+    return SocketIO(message_queue=SOCKETIO_MESSAGE_QUEUE).emit
+
+
+def run_worker(concurrency=WORKER_CONCURRENCY, emit=None, on_write=None):
+    """Claim and run scrape jobs forever, up to `concurrency` at a time.
+
+    on_write(brand) is called whenever a job has written a batch of products.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    pool = eventlet.GreenPool(concurrency)
+    logger.info('Scrape worker %s running %d jobs at a time', worker_id, concurrency)
+    while True:
+        job = claim_job(worker_id) if pool.free() else None
+        if job:
+            logger.info('Running job %s', job['_id'], extra={'brand': job['params']['brand'], 'attempt': job['attempts']})
+            pool.spawn_n(run_job, job, worker_id, emit, on_write)
+        else:
+            eventlet.sleep(JOB_POLL_INTERVAL)
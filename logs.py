@@ -0,0 +1,63 @@
+"""Logging setup shared by the web process, the worker and the command line tools.
+
+LOG_LEVEL picks the level (INFO by default; DEBUG adds a line per parsed
+page and Shopify call). LOG_FORMAT=json writes one JSON object per line with
+the fields passed through `extra=`, for log pipelines; the default is text.
+"""
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+def _extra(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(_extra(record))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The usual one-line format, with extra fields appended as key=value."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+def configure_logging(level=None, fmt=None):
+    handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if (fmt or LOG_FORMAT) == 'json' else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or LOG_LEVEL)
+    # Per-request lines from the HTTP clients are rarely what you are looking for
+    for name in ('urllib3', 'pyactiveresource', 'engineio', 'socketio'):
+        logging.getLogger(name).setLevel(max(root.level, logging.WARNING))
@@ -0,0 +1,137 @@
+"""Timers and counters for the pipeline's stages, in Prometheus' text format.
+
+    with timer('fetch'):                 # goodlooks_stage_seconds{stage="fetch"}
+        ...
+    count('scrape_products', outcome='updated')   # goodlooks_scrape_products_total{outcome="updated"}
+
+The web process serves them at /metrics; the worker serves its own on
+METRICS_PORT when that is set. Values are per process and reset on restart.
+"""
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import eventlet
+from dotenv import load_dotenv
+from eventlet import patcher, wsgi
+
+
+load_dotenv()
+# Port the worker serves /metrics on (the web process uses its own port)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+
+PREFIX = 'goodlooks'
+# Upper bounds (seconds) of the stage histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DESCRIPTIONS = {
+    'stage_seconds': 'Time spent in each pipeline stage',
+    'fetch_responses_total': 'Store page and image responses by status',
+    'scrape_products_total': 'Scraped product pages by outcome',
+    'db_writes_total': 'Documents written by bulk writes, by collection and result',
+    'emits_total': 'Socket.IO events sent, by event',
+    'shopify_throttled_total': 'Shopify calls answered 429 or THROTTLED, by API',
+    'images_stored_total': 'Images stored, by whether the content was new',
+    'revisits_total': 'Scheduled product revisits, by outcome',
+    'catalog_changes_total': 'Product changes sent to the catalog rooms',
+}
+
+# Image resizing runs on real OS threads (tpool): use a lock that is not greened
+_lock = patcher.original('threading').Lock()
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_counters = {}    # (name, labels) -> value
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def observe(stage, seconds, **labels):
+    key = _key('stage_seconds', dict(labels, stage=stage))
+    with _lock:
+        values = _histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+
+@contextmanager
+def timer(stage, **labels):
+    """Time the block as one observation of `stage` (errors included)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+
+def timed(stage, **labels):
+    """Decorator form of timer()."""
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1, **labels):
+    key = _key(f'{name}_total', labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _header(lines, name, kind):
+    lines.append(f"# HELP {PREFIX}_{name} {DESCRIPTIONS.get(name, name)}")
+    lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        _header(lines, name, 'histogram')
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, bucket in zip(BUCKETS, values):
+                lines.append(f"{PREFIX}_{name}_bucket{_labels(labels, [('le', str(bound))])} {bucket}")
+            lines.append(f"{PREFIX}_{name}_bucket{_labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{PREFIX}_{name}_sum{_labels(labels)} {values[-2]:.6f}")
+            lines.append(f"{PREFIX}_{name}_count{_labels(labels)} {values[-1]}")
+    for name in sorted({name for name, _ in counters}):
+        _header(lines, name, 'counter')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{PREFIX}_{name}{_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port=METRICS_PORT):
+    """Serve /metrics on `port` from a green thread (for processes without Flask)."""
+    def application(environ, start_response):
+        if environ['PATH_INFO'] != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [render().encode()]
+
+    return eventlet.spawn(wsgi.server, eventlet.listen(('0.0.0.0', port)), application, log_output=False)
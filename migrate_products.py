@@ -0,0 +1,62 @@
+"""Move the per-brand adidas/nike/jordan data into the single products collection.
+
+    python migrate_products.py                       # admin.adidas.json, admin.nike.json, admin.jordan.json
+    python migrate_products.py admin.nike.json       # specific exports
+    python migrate_products.py --from-collections adidas nike jordan
+
+Documents keep their _id, so existing /product/<id> links keep working, and
+re-running the migration only updates what is already there.
+"""
+import argparse
+import logging
+
+from pymongo import UpdateOne
+
+from logs import configure_logging
+from storage import BulkWriter, db, products_collection, ensure_product_indexes, product_key
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXPORTS = ['admin.adidas.json', 'admin.nike.json', 'admin.jordan.json']
+
+
+def migration_upsert(document):
+    document = dict(document)
+    _id = document.pop('_id', None)
+    if 'updated_at' not in document and _id is not None:
+        document['updated_at'] = _id.generation_time
+    update = {'$set': document}
+    if _id is not None:
+        update['$setOnInsert'] = {'_id': _id}
+    return UpdateOne(product_key(document), update, upsert=True)
+
+
+def migrate(documents, source):
+    with BulkWriter() as writer:
+        for document in documents:
+            writer.add(products_collection, migration_upsert(document))
+    logger.info('Migrated %s', source, extra=writer.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('exports', nargs='*', help='Extended JSON array exports to import')
+    parser.add_argument('--from-collections', nargs='+', metavar='NAME',
+                        help='copy the old per-brand collections instead of reading exports')
+    args = parser.parse_args()
+    configure_logging()
+    # catalog_dump builds on this module's upserts
+    from catalog_dump import iter_documents
+
+    ensure_product_indexes()
+    if args.from_collections:
+        for name in args.from_collections:
+            migrate(db[name].find(), name)
+    else:
+        for path in args.exports or DEFAULT_EXPORTS:
+            migrate(iter_documents(path), path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from xml.etree import ElementTree
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from metrics import timed
+
+try:
+    import lxml  # noqa: F401
+    SOUP_PARSER = 'lxml'
+except ImportError:
+    SOUP_PARSER = 'html.parser'
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
+
+
+# 'selectolax' when it is installed, otherwise BeautifulSoup on lxml
+PARSER_BACKEND = os.environ.get('PARSER_BACKEND') or ('selectolax' if HTMLParser else 'soup')
+
+logger = logging.getLogger(__name__)
+
+DETAILS_CLASS = 'product-details-tabs-description-flex-col'
+SLIDER_CLASS = 'product-image-slider'
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+
+def _classes(attrs):
+    # The strainer sees raw attributes, so class is still one string here
+    classes = attrs.get('class') or ''
+    return classes.split() if isinstance(classes, str) else classes
+
+
+# Only the nodes parse_product reads are kept in the tree; everything else on
+# the page (menus, footer, theme markup) is skipped while parsing
+def _product_nodes(name, attrs):
+    if name in ('h3', 'h4', 'script'):
+        return True
+    if name == 'meta':
+        return attrs.get('property') == 'og:price:amount'
+    if name == 'div':
+        classes = _classes(attrs)
+        return DETAILS_CLASS in classes or SLIDER_CLASS in classes
+    return False
+
+
+def _collection_items(name, attrs):
+    return name == 'a' and 'collection-item' in _classes(attrs)
+
+
+PRODUCT_STRAINER = SoupStrainer(_product_nodes)
+COLLECTION_STRAINER = SoupStrainer(_collection_items)
+
+
+class SoupPage:
+    """Product page lookups on a BeautifulSoup tree."""
+
+    def __init__(self, soup):
+        self.soup = soup
+
+    @classmethod
+    def parse(cls, content):
+        return cls(BeautifulSoup(content, SOUP_PARSER, parse_only=PRODUCT_STRAINER))
+
+    def first_text(self, name):
+        return self.soup.find(name).get_text(strip=True)
+
+    def price(self):
+        tag = self.soup.find('meta', property='og:price:amount')
+        return (True, tag.get('content')) if tag else (False, None)
+
+    def option_script(self):
+        script_tag = self.soup.find('script', text=re.compile('new Shopify\\.OptionSelectors'))
+        return script_tag.string if script_tag else None
+
+    def detail_items(self):
+        details_div = self.soup.find('div', class_=DETAILS_CLASS)
+        if not details_div:
+            return False, None
+        ul_tag = details_div.find('ul')
+        if not ul_tag:
+            return True, None
+        return True, [li.get_text(strip=True) for li in ul_tag.find_all('li')]
+
+    def slider_images(self):
+        thumbnail_slider = self.soup.find('div', class_=SLIDER_CLASS)
+        if not thumbnail_slider:
+            return None
+        return [img['src'] for img in thumbnail_slider.find_all('img') if 'src' in img.attrs]
+
+
+class SelectolaxPage:
+    """The same lookups on a selectolax (lexbor) tree."""
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    @classmethod
+    def parse(cls, content):
+        return cls(HTMLParser(content))
+
+    def first_text(self, name):
+        return self.tree.css_first(name).text(strip=True)
+
+    def price(self):
+        node = self.tree.css_first('meta[property="og:price:amount"]')
+        return (True, node.attributes.get('content')) if node else (False, None)
+
+    def option_script(self):
+        for node in self.tree.css('script'):
+            text = node.text(deep=True)
+            if 'new Shopify.OptionSelectors' in text:
+                return text
+        return None
+
+    def detail_items(self):
+        details_div = self.tree.css_first(f'div.{DETAILS_CLASS}')
+        if not details_div:
+            return False, None
+        ul_tag = details_div.css_first('ul')
+        if not ul_tag:
+            return True, None
+        return True, [li.text(strip=True) for li in ul_tag.css('li')]
+
+    def slider_images(self):
+        thumbnail_slider = self.tree.css_first(f'div.{SLIDER_CLASS}')
+        if not thumbnail_slider:
+            return None
+        return [img.attributes['src'] or '' for img in thumbnail_slider.css('img') if 'src' in img.attributes]
+
+
+def product_page(content, backend=None):
+    backend = backend or PARSER_BACKEND
+    if backend == 'selectolax' and HTMLParser:
+        return SelectolaxPage.parse(content)
+    return SoupPage.parse(content)
+
+
+# Hash only the parts of the page the product is built from; the rest of a
+# Shopify page (cart tokens, section ids, ...) changes on every request
+def product_fragment_hash(content):
+    fragments = re.findall(
+        rb'<meta[^>]+og:price:amount[^>]*>|new Shopify\.OptionSelectors\(.*?\);'
+        rb'|<div[^>]+product-details-tabs-description-flex-col.*?</ul>'
+        rb'|<div[^>]+product-image-slider.*?</div>\s*</div>',
+        content, re.DOTALL)
+    return hashlib.sha256(b''.join(fragments) or content).hexdigest()
+
+
+# Parse an already downloaded product page into the product dictionary
+@timed('parse')
+def parse_product(content, brand, page=None):
+    # Initialize an empty product dictionary to avoid UnboundLocalError
+    product = {}
+    variants = []  # To store variants/sub-products
+
+    try:
+        page = page or product_page(content)
+
+        # Scraping product details
+        product['Title'] = page.first_text('h3')  # Assuming h3 is for product title
+        product['Brand'] = brand
+        product['Color'] = page.first_text('h4')  # Assuming color is in h4
+
+        product['Material'] = 'Leather'
+        product['Age group'] = 'Adult'
+
+        has_price, price = page.price()
+        if has_price:
+            product['price'] = price
+        else:
+            product['price'] = 'Price not found'
+            logger.debug('Price meta tag not found')
+        # Check if there is embedded JavaScript containing product data
+        script_content = page.option_script()
+
+        if script_content:
+            # Use regex to find specific product fields like 'SKU', 'Size', etc.
+            size_match = re.search(r'"Size":"(.*?)"', script_content)
+            sku_match = re.search(r'"sku":"(.*?)"', script_content)
+            barcode_match = re.search(r'"barcode":"(.*?)"', script_content)
+            weight_match = re.search(r'"weight":(\d+)', script_content)
+            quantity_match = re.search(r'"inventory_quantity":(\d+)', script_content)
+            id_match = re.search(r'"id":(\d+)', script_content)
+            gender_match = re.search(r'"type":"(.*?)"', script_content)
+
+            # Extract and store the found values
+            product['Size'] = size_match.group(1) if size_match else 'Size not found'
+            product['SKU'] = sku_match.group(1) if sku_match else 'SKU not found'
+            product['Barcode'] = barcode_match.group(1) if barcode_match else 'Barcode not found'
+            product['Weight'] = weight_match.group(1) if weight_match else 'Weight not found'
+            product['Quantity'] = quantity_match.group(1) if quantity_match else 'Quantity not found'
+            product['id'] = id_match.group(1) if id_match else 'ID not found'
+            product['Gender'] = gender_match.group(1) if gender_match else 'gender not found'
+
+            # Add variants logic
+            product_data_match = re.search(r'product:\s*(\{.*\})', script_content)
+            if product_data_match:
+                product_data = json.loads(product_data_match.group(1))
+
+                # Add the original product details
+                product['id'] = product_data.get('id', 'ID not found')
+
+                # Loop through each variant to extract its specific details
+                for variant in product_data['variants']:
+                    variants.append({
+                        'Size': variant.get('option2', 'Size not found'),
+                        'ID': variant.get('id', 'ID not found'),
+                        'SKU': variant.get('sku', 'SKU not found'),
+                        'Barcode': variant.get('barcode', 'Barcode not found'),
+                        'Quantity': variant.get('inventory_quantity', 'Quantity not found'),
+                        'Weight': variant.get('weight', 'Weight not found')
+                    })
+        else:
+            logger.debug('No JavaScript object found containing product details')
+
+        # Add variants to the main product dictionary
+        product['Variants'] = variants
+
+        has_details, list_items = page.detail_items()
+        if has_details:
+            if list_items is not None:
+                # Combine list items with proper formatting and replace 'USG' with 'GOOD LOOKS'
+                product['product_detail'] = "\n".join(list_items).replace('USG', 'GOOD LOOKS')
+            else:
+                product = {'product_detail': 'No list found'}
+                logger.debug('No list found in product details')
+        else:
+            product = {'product_detail': 'Details not found'}
+            logger.debug('No product details found')
+
+        # Find the main div containing the thumbnail images
+        image_srcs = page.slider_images()
+        if image_srcs is not None:
+            # If the src starts with '//', add the https: prefix
+            images = ['https:' + src if src.startswith('//') else src for src in image_srcs]
+            product['Images'] = images
+        else:
+            logger.debug('No thumbnail slider found')
+
+        # Return the complete product dictionary
+        logger.debug('Parsed product', extra={'sku': product.get('SKU'), 'title': product.get('Title'),
+                                              'variants': len(product.get('Variants') or [])})
+        return product
+
+    except Exception as e:
+        logger.warning('Could not parse product page: %s', e)
+        return None
+
+
+# Find all products on a collection page
+def parse_collection_links(content):
+    soup = BeautifulSoup(content, SOUP_PARSER, parse_only=COLLECTION_STRAINER)
+    return [{'name': item.text.strip(), 'link': item['href']} for item in soup.find_all('a')]
+
+
+# Page numbers a collection page links to (?page=N in its pagination links)
+def parse_collection_pages(content):
+    text = content.decode('utf-8', 'replace') if isinstance(content, bytes) else content
+    return {int(n) for n in re.findall(r'href="[^"]*[?&](?:amp;)?page=(\d+)', text)}
+
+
+# Read a sitemap: returns (child sitemap URLs, [(url, lastmod)]) — a sitemap
+# index has the first, a urlset the second
+def parse_sitemap(content):
+    root = ElementTree.fromstring(content)
+    sitemaps, urls = [], []
+    for node in root:
+        tag = node.tag.rsplit('}', 1)[-1]
+        loc = node.findtext(f'{SITEMAP_NS}loc') or node.findtext('loc')
+        if not loc:
+            continue
+        lastmod = node.findtext(f'{SITEMAP_NS}lastmod') or node.findtext('lastmod')
+        if tag == 'sitemap':
+            sitemaps.append(loc.strip())
+        elif tag == 'url':
+            urls.append((loc.strip(), lastmod.strip() if lastmod else None))
+    return sitemaps, urls
@@ -0,0 +1,130 @@
+import html
+import re
+
+from fetcher import fetch
+
+
+# Shopify caps products.json pages at 250 products
+PRODUCTS_JSON_LIMIT = 250
+
+# Fields only the product page markup is guaranteed to have; if the JSON
+# endpoints leave one of them empty the page is loaded as a fallback
+HTML_FALLBACK_FIELDS = ('Color', 'product_detail', 'Images')
+# Per-size fields the page's variant data has, and the value the JSON mapping
+# leaves when they are unknown (products.json has no barcodes and, on public
+# storefronts, no stock counts)
+VARIANT_FALLBACK_FIELDS = {'Quantity': None, 'Barcode': 'Barcode not found'}
+
+
+def fetch_collection_pages(collection_url, limit=PRODUCTS_JSON_LIMIT):
+    """Page through <collection>/products.json, yielding each page's product list."""
+    page = 1
+    while True:
+        response = fetch(f"{collection_url}/products.json", params={'limit': limit, 'page': page})
+        response.raise_for_status()
+        products = response.json().get('products', [])
+        if products:
+            yield products
+        if len(products) < limit:
+            break
+        page += 1
+
+
+def fetch_product_js(base_url, handle):
+    """Fetch /products/<handle>.js, which also carries variant barcodes."""
+    response = fetch(f"{base_url}/products/{handle}.js")
+    response.raise_for_status()
+    return response.json()
+
+
+def _https(src):
+    return 'https:' + src if src.startswith('//') else src
+
+
+def _option_index(options, name, default):
+    # products.json lists options as dicts, the .js endpoint as plain names
+    names = [(o.get('name') if isinstance(o, dict) else o) or '' for o in options or []]
+    for i, option_name in enumerate(names):
+        if option_name.lower() == name:
+            return i + 1
+    return default
+
+
+def _price(value):
+    # products.json prices are "200.00" strings, the .js endpoint uses cents
+    if isinstance(value, int):
+        return f"{value / 100:.2f}"
+    return value
+
+
+def _details_from_html(body_html):
+    items = re.findall(r'<li[^>]*>(.*?)</li>', body_html or '', re.DOTALL)
+    lines = [html.unescape(re.sub(r'<[^>]+>', '', item)).strip() for item in items]
+    # Replace 'USG' with 'GOOD LOOKS' like the page scraper does
+    return "\n".join(lines).replace('USG', 'GOOD LOOKS')
+
+
+def product_from_json(data, brand):
+    """Map a products.json / .js product onto the dictionary parse_product returns."""
+    color_option = _option_index(data.get('options'), 'color', 1)
+    size_option = _option_index(data.get('options'), 'size', 2)
+
+    variants = []
+    for variant in data.get('variants', []):
+        # The public endpoints usually hide stock counts: None until the page gives them
+        quantity = variant.get('inventory_quantity')
+        variants.append({
+            'Size': variant.get(f'option{size_option}', 'Size not found'),
+            'ID': variant.get('id', 'ID not found'),
+            'SKU': variant.get('sku', 'SKU not found'),
+            'Barcode': variant.get('barcode', 'Barcode not found'),
+            'Quantity': quantity,
+            'Weight': variant.get('grams', variant.get('weight', 'Weight not found')),
+        })
+    first = variants[0] if variants else {}
+    first_variant = (data.get('variants') or [{}])[0]
+
+    images = [_https(image['src'] if isinstance(image, dict) else image)
+              for image in data.get('images', [])]
+
+    return {
+        'Title': data.get('title'),
+        'Brand': brand,
+        'Color': first_variant.get(f'option{color_option}') if len(data.get('options') or []) > 1 else None,
+        'Material': 'Leather',
+        'Age group': 'Adult',
+        'price': _price(first_variant.get('price', 'Price not found')),
+        'Size': first.get('Size', 'Size not found'),
+        'SKU': first.get('SKU', 'SKU not found'),
+        'Barcode': first.get('Barcode', 'Barcode not found'),
+        'Weight': first.get('Weight', 'Weight not found'),
+        'Quantity': first.get('Quantity', 'Quantity not found'),
+        'id': data.get('id', 'ID not found'),
+        'Gender': data.get('product_type') or data.get('type') or 'gender not found',
+        'Variants': variants,
+        'product_detail': _details_from_html(data.get('body_html') or data.get('description')),
+        'Images': images,
+    }
+
+
+def missing_html_fields(product):
+    missing = [field for field in HTML_FALLBACK_FIELDS if not product.get(field)]
+    missing += [field for field, unknown in VARIANT_FALLBACK_FIELDS.items()
+                if any(variant[field] == unknown for variant in product['Variants'])]
+    return missing
+
+
+def fill_from_page(product, page_product, fields):
+    """Copy the fields missing_html_fields named from the product page's parse."""
+    page_variants = {variant.get('ID'): variant for variant in page_product.get('Variants') or []}
+    for field in fields:
+        if field not in VARIANT_FALLBACK_FIELDS:
+            product[field] = page_product.get(field)
+            continue
+        # Per size: match the page's variants by ID
+        unknown = VARIANT_FALLBACK_FIELDS[field]
+        for variant in product['Variants']:
+            value = page_variants.get(variant['ID'], {}).get(field)
+            if variant[field] == unknown and value not in (None, unknown, f'{field} not found'):
+                variant[field] = value
+        product[field] = (product['Variants'] or [{}])[0].get(field)
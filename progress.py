@@ -0,0 +1,67 @@
+import os
+
+import eventlet
+from dotenv import load_dotenv
+
+from metrics import count, timer
+
+
+load_dotenv()
+# Product events of a job are coalesced into one 'progress' event per window (seconds)
+PROGRESS_WINDOW = float(os.environ.get('PROGRESS_WINDOW', 1))
+
+# Events that are batched; anything else is forwarded to the room right away
+BATCHED_EVENTS = ('product', 'product_failed')
+
+
+def job_room(job_id):
+    return f"job:{job_id}"
+
+
+class ProgressStream:
+    """An emit(event, payload) for run_scrape that only talks to one job's room.
+
+    'product' and 'product_failed' events are buffered and sent as a single
+    'progress' event at most once per window:
+
+        {"job_id": ..., "products": [<compact deltas>], "failed": [<names>]}
+
+    Clients fetch full documents on demand from /products?brand=..&sku=..
+    """
+
+    def __init__(self, emit, job_id, window=PROGRESS_WINDOW):
+        self.emit = emit
+        self.job_id = str(job_id)
+        self.room = job_room(job_id)
+        self.window = window
+        self.buffer = {'product': [], 'product_failed': []}
+        self.timer = None
+
+    def __call__(self, event, payload):
+        if event not in BATCHED_EVENTS:
+            # Keep ordering: whatever is buffered goes out before this event
+            self.flush()
+            self.send(event, dict(payload, job_id=self.job_id))
+            return
+        self.buffer[event].append(payload)
+        if self.timer is None:
+            self.timer = eventlet.spawn_after(self.window, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not any(self.buffer.values()):
+            return
+        batch = {
+            'job_id': self.job_id,
+            'products': self.buffer['product'],
+            'failed': [item['name'] for item in self.buffer['product_failed']],
+        }
+        self.buffer = {'product': [], 'product_failed': []}
+        self.send('progress', batch)
+
+    def send(self, event, payload):
+        with timer('emit', event=event):
+            self.emit(event, payload, to=self.room)
+        count('emits', event=event)
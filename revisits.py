@@ -0,0 +1,252 @@
+"""Revisit each product on its own schedule instead of re-scraping whole collections.
+
+Every product of the brands in REVISIT_BRANDS has an entry in revisit_schedule
+with its own revisit interval. After a visit the interval is halved when the
+price or a size's quantity changed and grows by half when nothing did, within
+REVISIT_MIN_INTERVAL..REVISIT_MAX_INTERVAL; products down to their last few
+sizes are revisited at least every REVISIT_LOW_STOCK_INTERVAL. The collections
+and the sitemap are read again every REVISIT_DISCOVERY_INTERVAL to enrol new
+products, drop removed ones and bring forward those whose <lastmod> moved.
+
+Everything sent to the store comes out of a budget of REVISIT_BUDGET_PER_HOUR
+requests per host (scrape jobs running in the same process included); when it
+is spent, due products wait, most overdue first. The worker runs the
+scheduler when REVISIT_BRANDS is set, and a lease in revisit_leases keeps
+a second worker from revisiting the same host.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+import eventlet
+import requests
+from dotenv import load_dotenv
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from discovery import discover_products
+from fetcher import fetch_all, requests_sent
+from metrics import count
+from scraper import SCRAPE_FAILED, run_scrape, scrape_product
+from storage import BulkWriter, db
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Store the scheduler revisits, and which of its brands (comma separated; none turns it off)
+REVISIT_URL = os.environ.get('REVISIT_URL', 'https://usgstore.com.au')
+REVISIT_BRANDS = [brand.strip() for brand in os.environ.get('REVISIT_BRANDS', '').split(',') if brand.strip()]
+# Requests the scheduler may send to one host per hour
+REVISIT_BUDGET_PER_HOUR = float(os.environ.get('REVISIT_BUDGET_PER_HOUR', 600))
+# Bounds of a product's revisit interval, and the interval of a new product (seconds)
+REVISIT_MIN_INTERVAL = float(os.environ.get('REVISIT_MIN_INTERVAL', 15 * 60))
+REVISIT_MAX_INTERVAL = float(os.environ.get('REVISIT_MAX_INTERVAL', 3 * 24 * 3600))
+REVISIT_INITIAL_INTERVAL = float(os.environ.get('REVISIT_INITIAL_INTERVAL', 6 * 3600))
+# Products with this many sizes in stock or fewer are revisited at least this often
+LOW_STOCK_SIZES = int(os.environ.get('LOW_STOCK_SIZES', 3))
+REVISIT_LOW_STOCK_INTERVAL = float(os.environ.get('REVISIT_LOW_STOCK_INTERVAL', 3600))
+# Seconds between reads of a brand's collection and the sitemap
+REVISIT_DISCOVERY_INTERVAL = float(os.environ.get('REVISIT_DISCOVERY_INTERVAL', 24 * 3600))
+# Seconds between scheduler rounds
+REVISIT_TICK = float(os.environ.get('REVISIT_TICK', 60))
+
+schedule_collection = db['revisit_schedule']
+# Per host: the process running its revisits, and when each brand was last discovered
+leases_collection = db['revisit_leases']
+
+# How the interval changes after a visit
+SPEEDUP = 0.5   # price or stock changed
+SLOWDOWN = 1.5  # nothing changed
+
+
+def ensure_revisit_indexes():
+    schedule_collection.create_index('url', unique=True)
+    schedule_collection.create_index([('host', 1), ('next_visit_at', 1)])
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _aware(moment):
+    # pymongo hands datetimes back without a timezone; they are stored in UTC
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment
+
+
+class RequestBudget:
+    """Requests the scheduler may still send to each host.
+
+    Refills at `per_hour` up to `burst` (five minutes' worth by default);
+    every request this process sent to the host since the last look is taken
+    out, whoever sent it.
+    """
+
+    def __init__(self, per_hour=REVISIT_BUDGET_PER_HOUR, burst=None):
+        self.rate = per_hour / 3600
+        self.burst = burst or max(1.0, per_hour / 12)
+        self.tokens = {}
+        self.updated = {}
+        self.seen = {}
+
+    def available(self, host):
+        now = time.monotonic()
+        sent = requests_sent[host]
+        tokens = min(self.burst, self.tokens.get(host, self.burst) + (now - self.updated.get(host, now)) * self.rate)
+        tokens -= sent - self.seen.get(host, sent)
+        self.tokens[host], self.updated[host], self.seen[host] = tokens, now, sent
+        return max(0, int(tokens))
+
+
+def stock_state(product):
+    """(hash of the price and per-size quantities, sizes in stock) of a scraped product."""
+    variants = product.get('Variants') or []
+    quantities = sorted((str(v.get('Size')), v.get('Quantity')) for v in variants)
+    signature = hashlib.sha1(json.dumps([product.get('price'), quantities], default=str).encode()).hexdigest()
+    return signature, sum(1 for v in variants if isinstance(v.get('Quantity'), int) and v['Quantity'] > 0)
+
+
+def next_interval(interval, changed, sizes_in_stock):
+    interval *= SPEEDUP if changed else SLOWDOWN
+    if sizes_in_stock is not None and 0 < sizes_in_stock <= LOW_STOCK_SIZES:
+        # The last few sizes of a product are the ones that sell out
+        interval = min(interval, REVISIT_LOW_STOCK_INTERVAL)
+    return min(REVISIT_MAX_INTERVAL, max(REVISIT_MIN_INTERVAL, interval))
+
+
+def revisit_fields(entry, status, product, now):
+    """The schedule fields to set after visiting `entry`'s page."""
+    fields = {'last_visit_at': now, 'last_status': status, 'changed': False}
+    if status == SCRAPE_FAILED:
+        # Try again after the same interval
+        fields['next_visit_at'] = now + timedelta(seconds=entry['interval'])
+        return fields
+
+    changed, sizes_in_stock = False, entry.get('sizes_in_stock')
+    if product:
+        # Unchanged pages (304 or the same fragment) come without a product
+        signature, sizes_in_stock = stock_state(product)
+        changed = entry.get('signature') is not None and signature != entry['signature']
+        fields.update(signature=signature, sizes_in_stock=sizes_in_stock)
+        if changed:
+            fields['last_changed_at'] = now
+    interval = next_interval(entry['interval'], changed, sizes_in_stock)
+    fields.update(interval=interval, next_visit_at=now + timedelta(seconds=interval), changed=changed)
+    return fields
+
+
+def enrol(base_url, brand, products, now, complete=True):
+    """Add a brand's discovered products to the schedule and drop the ones that are
+    gone. Nothing is dropped unless every collection page was read (complete)
+    and at least one product was found."""
+    host = urlparse(base_url).netloc
+    known = {entry['url']: entry.get('lastmod') for entry in schedule_collection.find(
+        {'url': {'$in': [url for url, _, _ in products]}}, {'url': 1, 'lastmod': 1})}
+    with BulkWriter() as writer:
+        for url, name, lastmod in products:
+            fields = {'brand': brand, 'base_url': base_url, 'host': host, 'name': name, 'lastmod': lastmod,
+                      'discovered_at': now}
+            update = {'$set': fields}
+            if url not in known:
+                update['$setOnInsert'] = {'interval': REVISIT_INITIAL_INTERVAL, 'next_visit_at': now}
+            elif lastmod and known[url] and lastmod != known[url]:
+                # The sitemap says the product changed: visit it on this round
+                fields['next_visit_at'] = now
+            writer.add(schedule_collection, UpdateOne({'url': url}, update, upsert=True))
+    removed = 0
+    if complete and products:
+        removed = schedule_collection.delete_many(
+            {'host': host, 'brand': brand, 'discovered_at': {'$lt': now}}).deleted_count
+    else:
+        # A failed page or an empty collection page says nothing about what left the store
+        logger.warning('Discovery of %s was incomplete or found nothing, no product is dropped from the schedule', brand)
+    logger.info('Revisit schedule of %s updated', brand,
+                extra={'products': len(products), 'new': len(products) - len(known), 'removed': removed})
+
+
+def hold_lease(host, owner, now):
+    """The host's lease document while `owner` holds it, None while another process does."""
+    try:
+        return leases_collection.find_one_and_update(
+            {'_id': host, '$or': [{'owner': owner}, {'expires_at': {'$lt': now}}]},
+            {'$set': {'owner': owner, 'expires_at': now + timedelta(seconds=REVISIT_TICK * 3)}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        return None
+
+
+def revisit(base_url, brand, entries, emit=None, on_write=None):
+    """Scrape the pages of `entries` (schedule entries of one brand) and reschedule them."""
+    entries = {entry['url']: entry for entry in entries}
+    visited = {}
+
+    def results():
+        for url, result in fetch_all(entries, lambda u: scrape_product(u, brand, entries[u].get('lastmod'))):
+            status, product, validator = result or (SCRAPE_FAILED, None, None)
+            visited[url] = (status, product)
+            yield url, entries[url].get('name'), status, product, validator
+
+    counts = run_scrape(base_url, brand, emit=emit, results=results(),
+                        on_flush=on_write and (lambda: on_write(brand)))
+    with BulkWriter() as writer:
+        for url, (status, product) in visited.items():
+            fields = revisit_fields(entries[url], status, product, _now())
+            writer.add(schedule_collection, UpdateOne({'_id': entries[url]['_id']}, {'$set': fields}))
+            count('revisits', outcome='changed' if fields['changed'] else status)
+    return counts
+
+
+def run_round(base_url, brands, owner, budget, emit=None, on_write=None):
+    """One scheduler round for a store: discovery when it is due, then the due products
+    the budget allows. Returns the number of products visited (None without the lease)."""
+    host = urlparse(base_url).netloc
+    now = _now()
+    lease = hold_lease(host, owner, now)
+    if not lease:
+        return None
+
+    discovered = lease.get('discovered') or {}
+    for brand in brands:
+        last = discovered.get(brand)
+        if last and now - _aware(last) < timedelta(seconds=REVISIT_DISCOVERY_INTERVAL):
+            continue
+        if not budget.available(host):
+            break
+        try:
+            products, complete = discover_products(base_url, f"{base_url}/collections/{brand.lower()}")
+        except requests.exceptions.RequestException as e:
+            logger.warning('Could not read the collection of %s: %s', brand, e)
+            continue
+        enrol(base_url, brand, products, now, complete)
+        leases_collection.update_one({'_id': host}, {'$set': {f'discovered.{brand}': now}})
+
+    allowed = budget.available(host)
+    if not allowed:
+        return 0
+    due = list(schedule_collection.find({'host': host, 'brand': {'$in': brands}, 'next_visit_at': {'$lte': now}})
+               .sort('next_visit_at', 1).limit(allowed))
+    for brand in brands:
+        entries = [entry for entry in due if entry['brand'] == brand]
+        if entries:
+            counts = revisit(base_url, brand, entries, emit, on_write)
+            logger.info('Revisited %d %s products', len(entries), brand, extra=counts)
+    return len(due)
+
+
+def run_scheduler(base_url=REVISIT_URL, brands=REVISIT_BRANDS, emit=None, on_write=None):
+    """Run scheduler rounds forever (the worker starts it in a green thread)."""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    budget = RequestBudget()
+    logger.info('Revisit scheduler running for %s', ', '.join(brands),
+                extra={'url': base_url, 'budget_per_hour': REVISIT_BUDGET_PER_HOUR})
+    while True:
+        try:
+            run_round(base_url, brands, owner, budget, emit, on_write)
+        except PyMongoError as e:
+            logger.warning('Revisit round failed: %s', e)
+        eventlet.sleep(REVISIT_TICK)
@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+import requests
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from discovery import discover_products
+from fetcher import fetch, fetch_all, conditional_headers
+from images import MIRROR_IMAGES, ImageMirror
+from metrics import count
+from products_json import fetch_collection_pages, fetch_product_js, fill_from_page, missing_html_fields, product_from_json
+from parsers import parse_product, product_fragment_hash
+from storage import BulkWriter, db, products_collection, product_key
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 'html' loads every product page, 'json' reads the collection's products.json
+# (unchanged products cost no request; a new or changed one still costs its
+# page, since the public JSON has no stock counts)
+SCRAPE_MODE = os.environ.get('SCRAPE_MODE', 'html')
+# Seconds between checkpoints of a running scrape
+CHECKPOINT_INTERVAL = float(os.environ.get('CHECKPOINT_INTERVAL', 5))
+
+# ETag / Last-Modified / fragment hash of every scraped product page
+validators_collection = db['scrape_validators']
+
+# Outcomes of scrape_product
+SCRAPE_UPDATED = 'updated'
+SCRAPE_UNCHANGED = 'unchanged'
+SCRAPE_FAILED = 'failed'
+
+
+def ensure_validator_index():
+    validators_collection.create_index('url', unique=True)
+
+
+def record_validators(validators):
+    """Store the validators of pages whose products have been written: [(url, fields)]."""
+    if validators:
+        validators_collection.bulk_write([UpdateOne({'url': url}, {'$set': fields}, upsert=True)
+                                          for url, fields in validators], ordered=False)
+
+
+# Function to scrape product data from USG Store
+# Returns (status, product, validator). Pages that answer 304 or whose product
+# fragment hashes the same as last time are reported unchanged and are not
+# parsed. The validator of an updated page (with lastmod, the product's sitemap
+# date) is left to the caller to record once the product has been written, so a
+# lost write is not mistaken for an unchanged page next time.
+def scrape_product(url, brand, lastmod=None):
+    validator = validators_collection.find_one({'url': url})
+    try:
+        response = fetch(url, headers=conditional_headers(validator))
+        if response.status_code == 304:
+            if lastmod:
+                validators_collection.update_one({'url': url}, {'$set': {'lastmod': lastmod}})
+            return SCRAPE_UNCHANGED, None, None
+        response.raise_for_status()  # Raise an error for invalid responses
+    except requests.exceptions.RequestException as e:
+        logger.warning('Could not fetch product page: %s', e, extra={'url': url})
+        return SCRAPE_FAILED, None, None
+
+    fragment_hash = product_fragment_hash(response.content)
+    unchanged = validator is not None and validator.get('hash') == fragment_hash
+    product = None if unchanged else parse_product(response.content, brand)
+    if not unchanged and not product:
+        return SCRAPE_FAILED, None, None
+
+    validator = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'hash': fragment_hash,
+    }
+    if lastmod:
+        validator['lastmod'] = lastmod
+    if unchanged:
+        # The product behind this hash is already stored
+        validators_collection.update_one({'url': url}, {'$set': validator}, upsert=True)
+        return SCRAPE_UNCHANGED, None, None
+    return SCRAPE_UPDATED, product, validator
+
+
+# Read every page of the collection and scrape the product pages that are new
+# or changed since the last scrape. Yields (url, name, status, product, validator)
+# as each page finishes; products whose sitemap lastmod has not moved are
+# yielded unchanged without a request.
+def scrape_collection_html(collection_url, base_url, brand, skip_urls=()):
+    discovered, _ = discover_products(base_url, collection_url)
+    products = {url: (name, lastmod) for url, name, lastmod in discovered if url not in skip_urls}
+    recorded = {v['url']: v.get('lastmod') for v in validators_collection.find(
+        {'url': {'$in': [url for url, (_, lastmod) in products.items() if lastmod]}}, {'url': 1, 'lastmod': 1})}
+
+    queue = {}
+    for product_url, (name, lastmod) in products.items():
+        if lastmod and recorded.get(product_url) == lastmod:
+            yield product_url, name, SCRAPE_UNCHANGED, None, None
+        else:
+            queue[product_url] = (name, lastmod)
+
+    # Product pages are fetched on a bounded green pool and handled as they finish
+    for product_url, result in fetch_all(queue, lambda u: scrape_product(u, brand, queue[u][1])):
+        yield (product_url, queue[product_url][0]) + (result or (SCRAPE_FAILED, None, None))
+
+
+# Alternate ingestion mode: read the collection through Shopify's products.json
+# instead of loading and parsing every product page. Yields (url, name, status, product,
+# validator) like the page scraper. Products whose JSON is unchanged cost no request;
+# product pages are only loaded for fields the JSON lacks, which on public storefronts
+# means every new or changed product (stock counts), and the page's variant data
+# then supplies the barcodes too.
+def scrape_collection_json(collection_url, base_url, brand, skip_urls=()):
+    changed = {}
+    try:
+        for page in fetch_collection_pages(collection_url):
+            hashes = {
+                f"{base_url}/products/{data['handle']}": (data, hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest())
+                for data in page
+            }
+            hashes = {url: value for url, value in hashes.items() if url not in skip_urls}
+            known = {v['url']: v.get('json_hash') for v in validators_collection.find({'url': {'$in': list(hashes)}})}
+            for product_url, (data, json_hash) in hashes.items():
+                if known.get(product_url) == json_hash:
+                    yield product_url, data.get('title'), SCRAPE_UNCHANGED, None, None
+                else:
+                    changed[product_url] = (data, json_hash)
+    except requests.exceptions.RequestException as e:
+        logger.warning('Could not fetch products.json: %s', e, extra={'url': collection_url})
+
+    def enrich(product_url):
+        data, json_hash = changed[product_url]
+        try:
+            product = product_from_json(data, brand)
+            missing = missing_html_fields(product)
+            if missing == ['Barcode']:
+                # Only the barcodes (which products.json lacks) are missing: the small .js document has them
+                product = product_from_json(fetch_product_js(base_url, data['handle']), brand)
+                missing = missing_html_fields(product)
+            if missing:
+                # The page's variant data has barcodes and stock counts, so no .js is needed
+                response = fetch(product_url)
+                response.raise_for_status()
+                fill_from_page(product, parse_product(response.content, brand) or {}, missing)
+        except requests.exceptions.RequestException as e:
+            logger.warning('Could not fetch product: %s', e, extra={'url': product_url})
+            return SCRAPE_FAILED, None, None
+
+        # Recorded with the product's write, like a page's validator
+        return SCRAPE_UPDATED, product, {'json_hash': json_hash}
+
+    for product_url, result in fetch_all(changed, enrich):
+        yield (product_url, changed[product_url][0].get('title')) + (result or (SCRAPE_FAILED, None, None))
+
+
+def product_item_from(product_data):
+    """The document stored in the products collection for a scraped product."""
+    return {
+        "sku": product_data.get('SKU'),
+        "title": product_data.get('Title'),
+        "brand": product_data.get('Brand'),
+        "color": product_data.get('Color'),
+        "gender": product_data.get('Gender'),
+        "material": product_data.get('Material'),
+        "age_group": product_data.get('Age group'),
+        "size": product_data.get('Size'),
+        "barcode": product_data.get('Barcode'),
+        "weight": product_data.get('Weight'),
+        "quantity": product_data.get('Quantity'),
+        "Variants": product_data.get('Variants'),
+        "Images": product_data.get('Images'),
+        "product_detail": product_data.get('product_detail'),
+        "price": product_data.get("price"),
+        "updated_at": datetime.now(timezone.utc)
+    }
+
+
+def product_delta(product_item):
+    """The few fields the dashboard needs to show a product that was just scraped."""
+    variants = product_item.get('Variants') or []
+    return {
+        'brand': product_item['brand'],
+        'sku': product_item['sku'],
+        'title': product_item['title'],
+        'price': product_item['price'],
+        'image': (product_item.get('Images') or [''])[0],
+        'sizes_in_stock': sum(1 for v in variants if isinstance(v.get('Quantity'), int) and v['Quantity'] > 0),
+    }
+
+
+def run_scrape(url, brand, mode=None, emit=None, skip_urls=(), checkpoint=None, on_flush=None, mirror_images=None,
+               results=None):
+    """Scrape one brand collection of the store at `url` into Mongo.
+
+    emit(event, payload) receives 'update' status messages, a compact
+    'product' delta per saved product and 'product_failed' per failure.
+    checkpoint(results) is called every CHECKPOINT_INTERVAL seconds, and at
+    the end, with the (url, status) pairs whose writes have been flushed;
+    URLs in skip_urls (an earlier checkpoint) are not visited again. With
+    mirror_images (MIRROR_IMAGES by default) product images are copied into
+    the local image store in the background before the product is saved.
+    results, when given, are the (url, name, status, product, validator) of
+    pages already visited by the caller, stored instead of scraping the
+    collection. A page's validator is recorded only once its product has
+    been written.
+    Returns the updated / unchanged / failed counts.
+    """
+    emit = emit or (lambda event, payload: None)
+    base_url = url
+    # Append brand-specific path to the base URL
+    collection_url = f"{url}/collections/{brand.lower()}"
+
+    # Emit real-time updates via SocketIO
+    emit('update', {'message': f'Starting to scrape {brand} products...'})
+
+    counts = {SCRAPE_UPDATED: 0, SCRAPE_UNCHANGED: 0, SCRAPE_FAILED: 0}
+    if results is None and (mode or SCRAPE_MODE) == 'json':
+        # Read the collection from products.json instead of the HTML pages
+        results = scrape_collection_json(collection_url, base_url, brand, skip_urls)
+    elif results is None:
+        results = scrape_collection_html(collection_url, base_url, brand, skip_urls)
+
+    pending = []  # (url, status) seen since the last checkpoint
+    last_checkpoint = time.monotonic()
+
+    mirror = ImageMirror() if (MIRROR_IMAGES if mirror_images is None else mirror_images) else None
+
+    unrecorded = {}  # id(write) -> (url, validator) of products not flushed yet
+
+    def flushed():
+        # Validators follow the products that made it into Mongo; a rejected
+        # write leaves its page to be scraped again
+        failed = {id(operation) for operation in writer.failed}
+        done = [(id(operation), unrecorded.pop(id(operation), None)) for operation in writer.sent]
+        record_validators([item for key, item in done if item and key not in failed])
+        if on_flush:
+            on_flush()
+
+    with BulkWriter(on_flush=flushed) as writer:
+        def save(product_item, images, product_url, validator):
+            if images != product_item['Images']:
+                # Keep where the images came from; Images now points at the local copies
+                product_item = dict(product_item, Images=images, source_images=product_item['Images'])
+            # Insert or update by brand + SKU; writes are batched into a few bulk_write calls
+            write = UpdateOne(product_key(product_item), {'$set': product_item}, upsert=True)
+            if validator:
+                unrecorded[id(write)] = (product_url, validator)
+            writer.add(products_collection, write)
+
+        def save_checkpoint():
+            # Only report products whose writes have reached Mongo
+            if mirror:
+                mirror.wait()
+            writer.flush()
+            if checkpoint and pending:
+                checkpoint(list(pending))
+            pending.clear()
+
+        for product_url, name, status, product_data, validator in results:
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                # Before this result is handled, so every URL in pending has had its write queued
+                save_checkpoint()
+                last_checkpoint = time.monotonic()
+            counts[status] += 1
+            count('scrape_products', outcome=status)
+            pending.append((product_url, status))
+
+            if status == SCRAPE_UNCHANGED:
+                # Nothing changed since the last sync: no parse, no DB write
+                continue
+
+            if status == SCRAPE_FAILED:
+                # Emit a message indicating that fetching or parsing this product failed
+                emit('product_failed', {'name': name})
+                continue
+
+            # Save the scraped product data to MongoDB
+            gender = product_data.get('Gender', '').strip()  # Ensure to strip any leading/trailing spaces
+            # Make comparison case-insensitive
+            if gender.lower() not in ["mens footwear", "womens footwear"]:
+                continue
+
+            product_item = product_item_from(product_data)
+            if mirror and product_item['Images']:
+                mirror.submit(product_item['Images'], lambda images, item=product_item, url=product_url,
+                              validator=validator: save(item, images, url, validator))
+            else:
+                save(product_item, product_item['Images'], product_url, validator)
+
+            # Emit a compact delta; clients load the full document on demand
+            emit('product', product_delta(product_item))
+
+        save_checkpoint()
+
+    # Emit a completion message after all products are processed
+    logger.info('Scrape of %s finished', brand, extra=dict(counts, brand=brand, writes=writer.stats))
+    emit('update', {
+        'message': f"All products have been processed. {counts[SCRAPE_UPDATED]} updated, "
+                   f"{counts[SCRAPE_UNCHANGED]} unchanged, {counts[SCRAPE_FAILED]} failed.",
+        'summary': counts,
+    })
+    return counts
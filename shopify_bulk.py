@@ -0,0 +1,234 @@
+"""Publish the Mongo catalog to Shopify with one GraphQL bulk operation.
+
+    python shopify_bulk.py                  # every product
+    python shopify_bulk.py --brand Nike     # one brand
+    python shopify_bulk.py --dry-run        # only write the JSONL file (calls nothing on Shopify)
+
+Every product becomes one productSet line in a JSONL file that is staged on
+Shopify and run with bulkOperationRunMutation, so a full publish costs a
+handful of API calls instead of one create/save plus one inventory call per
+variant. The result file is read back and the Shopify product, variant and
+inventory item IDs are stored on the products under `shopify`.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import requests
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from logs import configure_logging
+from shopify_client import graphql, user_errors
+from shopify_index import ensure_index_built, lookup_sku, product_gid, record_bulk_result
+from shopify_sync import hashes_document, sync_hashes
+from storage import BulkWriter, products_collection
+from upload_shopify import get_location_id, transform_mongo_to_shopify
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Seconds between bulk operation status checks
+BULK_POLL_INTERVAL = float(os.environ.get('BULK_POLL_INTERVAL', 5))
+
+PRODUCT_SET_MUTATION = """
+mutation call($input: ProductSetInput!) {
+  productSet(input: $input) {
+    product {
+      id
+      variants(first: 250) { nodes { id sku barcode title inventoryItem { id } } }
+    }
+    userErrors { field message }
+  }
+}
+"""
+
+STAGED_UPLOAD_MUTATION = """
+mutation {
+  stagedUploadsCreate(input: [{resource: BULK_MUTATION_VARIABLES, filename: "products.jsonl",
+                               mimeType: "text/jsonl", httpMethod: POST}]) {
+    stagedTargets { url parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
+
+RUN_MUTATION = """
+mutation run($mutation: String!, $path: String!) {
+  bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+POLL_QUERY = """
+query poll($id: ID!) {
+  node(id: $id) { ... on BulkOperation { id status errorCode objectCount url partialDataUrl } }
+}
+"""
+
+FINISHED_STATES = ('COMPLETED', 'FAILED', 'CANCELED', 'EXPIRED')
+
+
+def product_set_input(m_product, product_data, location_id=None):
+    """The productSet input for a Mongo product, from its transform_mongo_to_shopify data
+    (the same transform as the REST upload). Without location_id no stock levels are set."""
+    option_name = product_data['options'][0]['name']
+    product_input = {
+        'title': product_data['title'],
+        'descriptionHtml': product_data['body_html'],
+        'vendor': product_data['vendor'],
+        'productType': product_data['product_type'],
+        'tags': product_data['tags'],
+        'status': product_data['status'].upper(),
+        'productOptions': [{'name': option_name,
+                            'values': [{'name': value} for value in product_data['options'][0]['values']]}],
+        'variants': [{
+            'optionValues': [{'optionName': option_name, 'name': variant['option1']}],
+            'price': variant['price'],
+            'barcode': variant['barcode'],
+            'inventoryPolicy': 'DENY',
+            'inventoryItem': {'sku': variant['sku'], 'tracked': True, 'requiresShipping': True},
+            # An unknown stock count is left out rather than sent as zero
+            'inventoryQuantities': [{'locationId': f"gid://shopify/Location/{location_id}",
+                                     'name': 'available', 'quantity': variant['inventory_quantity']}]
+            if location_id and isinstance(variant['inventory_quantity'], int) else [],
+        } for variant in product_data['variants']],
+        'files': [{'originalSource': image['src'], 'contentType': 'IMAGE'}
+                  for image in product_data['images'] if 'src' in image],
+    }
+    shopify_id = (m_product.get('shopify') or {}).get('product_id')
+    if not shopify_id:
+        # Put on the store by the REST upload or shopify_sync.py before it was recorded here
+        entry = lookup_sku(product_data['variants'][0]['sku'])
+        shopify_id = entry and product_gid(entry['product_id'])
+    if shopify_id:
+        # Update the product published earlier instead of creating a second one
+        product_input['id'] = shopify_id
+    return product_input
+
+
+def write_bulk_file(products, path, location_id=None, upload_images=True):
+    """Write one productSet line per product; returns (Mongo _id, sync hashes) in line order.
+    Stock levels are set at location_id; without upload_images, local images not yet on
+    Shopify are left out instead of staged."""
+    ids = []
+    with open(path, 'w') as f:
+        for m_product in products:
+            try:
+                product_data = transform_mongo_to_shopify(m_product, upload_images=upload_images)
+                line = {'input': product_set_input(m_product, product_data, location_id)}
+                hashes = hashes_document(sync_hashes(product_data))
+            except (KeyError, TypeError, AttributeError, IndexError) as e:
+                logger.warning('Skipping %s: incomplete product (%r)', m_product.get('sku'), e)
+                continue
+            f.write(json.dumps(line) + '\n')
+            ids.append((m_product['_id'], hashes))
+    return ids
+
+
+def stage_bulk_file(path):
+    target = user_errors(graphql(STAGED_UPLOAD_MUTATION)['stagedUploadsCreate'])['stagedTargets'][0]
+    parameters = {p['name']: p['value'] for p in target['parameters']}
+    with open(path, 'rb') as f:
+        response = requests.post(target['url'], data=parameters, files={'file': f}, timeout=300)
+    response.raise_for_status()
+    return parameters['key']
+
+
+def run_bulk_mutation(staged_path):
+    result = graphql(RUN_MUTATION, {'mutation': PRODUCT_SET_MUTATION, 'path': staged_path})
+    return user_errors(result['bulkOperationRunMutation'])['bulkOperation']['id']
+
+
+def wait_for_bulk_operation(operation_id, interval=BULK_POLL_INTERVAL):
+    while True:
+        operation = graphql(POLL_QUERY, {'id': operation_id})['node']
+        logger.info('Bulk operation %s: %s products', operation['status'], operation['objectCount'])
+        if operation['status'] in FINISHED_STATES:
+            return operation
+        time.sleep(interval)
+
+
+def shopify_ids(result):
+    """The `shopify` field stored on a product from one productSet result."""
+    product = result['product']
+    return {
+        'product_id': product['id'],
+        # A variant's title is its size, the product's only option
+        'variants': [{'sku': v['sku'], 'barcode': v.get('barcode'), 'option1': v.get('title'), 'id': v['id'],
+                      'inventory_item_id': v['inventoryItem']['id']}
+                     for v in product['variants']['nodes']],
+        'synced_at': datetime.now(timezone.utc),
+    }
+
+
+def store_results(result_url, ids):
+    """Read the bulk result JSONL back into Mongo and the SKU index. Returns (published, failed)."""
+    published = failed = 0
+    response = requests.get(result_url, stream=True, timeout=300)
+    response.raise_for_status()
+    with BulkWriter() as writer:
+        for raw in response.iter_lines():
+            if not raw:
+                continue
+            line = json.loads(raw)
+            _id, hashes = ids[line['__lineNumber']]
+            result = (line.get('data') or {}).get('productSet') or {}
+            if result.get('userErrors') or not result.get('product'):
+                failed += 1
+                logger.warning('Product %s was not published: %s', _id, result.get('userErrors') or line.get('errors'))
+                continue
+            ids_field = shopify_ids(result)
+            # What was published is what shopify_sync compares against next time
+            writer.add(products_collection, UpdateOne({'_id': _id}, {'$set': {'shopify': dict(ids_field, hashes=hashes)}}))
+            record_bulk_result(ids_field['product_id'], ids_field['variants'], writer=writer)
+            published += 1
+    return published, failed
+
+
+def publish_catalog(query=None, dry_run=False):
+    with tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False) as f:
+        path = f.name
+    try:
+        # A dry run calls nothing on Shopify: no location, no index build, no image uploads
+        location_id = None
+        if not dry_run:
+            location_id = get_location_id()
+            # Products already on the store are found through the SKU index
+            ensure_index_built()
+        ids = write_bulk_file(products_collection.find(query or {}), path, location_id, upload_images=not dry_run)
+        logger.info('Wrote %d products to %s', len(ids), path)
+        if dry_run or not ids:
+            return None
+
+        operation = wait_for_bulk_operation(run_bulk_mutation(stage_bulk_file(path)))
+        if operation['status'] != 'COMPLETED':
+            logger.error('Bulk operation ended %s (%s)', operation['status'], operation['errorCode'])
+        result_url = operation['url'] or operation['partialDataUrl']
+        if result_url:
+            published, failed = store_results(result_url, ids)
+            logger.info('%d products published, %d failed', published, failed)
+        return operation
+    finally:
+        if not dry_run:
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--brand', help='only publish this brand')
+    parser.add_argument('--dry-run', action='store_true', help='write the JSONL file and stop')
+    args = parser.parse_args()
+    configure_logging()
+    publish_catalog({'brand': args.brand} if args.brand else None, dry_run=args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import shopify
+from dotenv import load_dotenv
+from pyactiveresource.connection import ClientError
+
+from metrics import count, timer
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+ACCESS_TOKEN = os.environ.get('ACCESS_TOKEN')
+shop_admin_url = "https://revamped-retail-boutique.myshopify.com/admin"
+headers = {
+    "X-Shopify-Access-Token": ACCESS_TOKEN
+} if ACCESS_TOKEN else {}
+# GraphQL calls (bulk operations, productSet, staged uploads) need a newer API
+# version than the REST client in upload_shopify uses
+SHOPIFY_GRAPHQL_API_VERSION = os.environ.get('SHOPIFY_GRAPHQL_API_VERSION', '2024-10')
+graphql_url = f"{shop_admin_url}/api/{SHOPIFY_GRAPHQL_API_VERSION}/graphql.json"
+
+# Shopify's REST bucket: 40 calls that drain at 2 per second (standard plans)
+SHOPIFY_REST_BUCKET = int(os.environ.get('SHOPIFY_REST_BUCKET', 40))
+SHOPIFY_REST_LEAK_RATE = float(os.environ.get('SHOPIFY_REST_LEAK_RATE', 2))
+# GraphQL cost points: 1000 available, restored at 50 per second
+SHOPIFY_GRAPHQL_BUCKET = int(os.environ.get('SHOPIFY_GRAPHQL_BUCKET', 1000))
+SHOPIFY_GRAPHQL_RESTORE_RATE = float(os.environ.get('SHOPIFY_GRAPHQL_RESTORE_RATE', 50))
+# Calls kept in reserve so other apps on the store are not starved
+SHOPIFY_HEADROOM = float(os.environ.get('SHOPIFY_HEADROOM', 0.1))
+# Uploads run at the same time; the buckets keep them inside the limit
+SHOPIFY_CONCURRENCY = int(os.environ.get('SHOPIFY_CONCURRENCY', 4))
+# 429s retried before giving up
+SHOPIFY_MAX_RETRIES = int(os.environ.get('SHOPIFY_MAX_RETRIES', 5))
+
+# Query cost assumed for a GraphQL call before Shopify has told us its real cost
+DEFAULT_QUERY_COST = 50
+
+
+class ShopifyThrottled(Exception):
+    pass
+
+
+class ShopifyGraphQLError(Exception):
+    pass
+
+
+class LeakyBucket:
+    """Local model of one of Shopify's leaky buckets.
+
+    acquire(cost) waits until the request fits under the limit (less the
+    headroom); observe() resyncs the model with the state a response reports,
+    and pause() holds every caller back after a 429.
+    """
+
+    def __init__(self, capacity, leak_rate, headroom=SHOPIFY_HEADROOM):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.limit = capacity * (1 - headroom)
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _leak(self, now):
+        self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+        self.updated = now
+
+    def acquire(self, cost=1):
+        cost = min(cost, self.limit)
+        # Holding the lock while waiting keeps callers in order
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self._leak(now)
+                wait = max(self.blocked_until - now, (self.level + cost - self.limit) / self.leak_rate)
+                if wait <= 0:
+                    self.level += cost
+                    return
+                time.sleep(wait)
+
+    def observe(self, level, capacity=None, leak_rate=None):
+        with self.lock:
+            if capacity and capacity != self.capacity:
+                self.limit = self.limit / self.capacity * capacity
+                self.capacity = capacity
+            if leak_rate:
+                self.leak_rate = leak_rate
+            self.updated = time.monotonic()
+            self.level = float(level)
+
+    def pause(self, seconds):
+        """Shopify said the bucket is full: send nothing for `seconds`."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self._leak(time.monotonic())
+            self.level = max(self.level, self.limit)
+
+
+def _header(headers, name):
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def _retry_after(headers):
+    try:
+        return float(_header(headers, 'Retry-After') or 2)
+    except ValueError:
+        return 2.0
+
+
+class ShopifyClient:
+    """Runs Shopify API calls just under the store's rate limits.
+
+    REST calls go through rest(); GraphQL through graphql(). Both wait for
+    room in their bucket before sending, update the bucket from
+    X-Shopify-Shop-Api-Call-Limit / the GraphQL cost extension, and only back
+    off when Shopify actually answers 429 (or THROTTLED).
+    """
+
+    def __init__(self):
+        self.rest_bucket = LeakyBucket(SHOPIFY_REST_BUCKET, SHOPIFY_REST_LEAK_RATE)
+        self.graphql_bucket = LeakyBucket(SHOPIFY_GRAPHQL_BUCKET, SHOPIFY_GRAPHQL_RESTORE_RATE)
+        self.query_costs = {}  # query text -> last actual cost
+        self.session = requests.Session()
+
+    def rest(self, call, *args, **kwargs):
+        """call(*args, **kwargs) is a ShopifyAPI resource call, e.g. shopify.Product.find."""
+        for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+            self.rest_bucket.acquire()
+            try:
+                with timer('shopify_call', api='rest'):
+                    result = call(*args, **kwargs)
+            except ClientError as e:
+                if e.code != 429 or attempt == SHOPIFY_MAX_RETRIES:
+                    raise
+                count('shopify_throttled', api='rest')
+                wait = _retry_after(e.response.headers)
+                logger.warning('Shopify REST limit hit, retrying in %ss', wait)
+                self.rest_bucket.pause(wait)
+                continue
+            self._observe_rest()
+            return result
+        raise ShopifyThrottled('REST call limit')
+
+    def _observe_rest(self):
+        response = shopify.ShopifyResource.connection.response
+        limit = response and _header(response.headers, 'X-Shopify-Shop-Api-Call-Limit')
+        if limit:
+            used, capacity = limit.split('/')
+            self.rest_bucket.observe(int(used), int(capacity))
+
+    def graphql(self, url, headers, query, variables=None):
+        """POST a GraphQL query; returns the parsed body. Raises ShopifyThrottled
+        if the query is still throttled after SHOPIFY_MAX_RETRIES."""
+        cost = self.query_costs.get(query, DEFAULT_QUERY_COST)
+        for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+            self.graphql_bucket.acquire(cost)
+            with timer('shopify_call', api='graphql'):
+                response = self.session.post(url, json={'query': query, 'variables': variables},
+                                             headers=headers, timeout=30)
+            if response.status_code == 429:
+                count('shopify_throttled', api='graphql')
+                self.graphql_bucket.pause(_retry_after(response.headers))
+                continue
+            response.raise_for_status()
+            body = response.json()
+
+            cost_info = (body.get('extensions') or {}).get('cost')
+            if cost_info:
+                throttle = cost_info['throttleStatus']
+                self.graphql_bucket.observe(throttle['maximumAvailable'] - throttle['currentlyAvailable'],
+                                            throttle['maximumAvailable'], throttle['restoreRate'])
+                self.query_costs[query] = cost_info.get('actualQueryCost') or cost_info['requestedQueryCost']
+
+            throttled = any((error.get('extensions') or {}).get('code') == 'THROTTLED'
+                            for error in body.get('errors') or [])
+            if not throttled:
+                return body
+            count('shopify_throttled', api='graphql')
+            if cost_info:
+                # The bucket now knows what is available; acquire() waits until
+                # the points this query needs have been restored
+                cost = self.query_costs[query] = cost_info['requestedQueryCost']
+            else:
+                self.graphql_bucket.pause(1)
+        raise ShopifyThrottled('GraphQL cost limit')
+
+    def map(self, fn, items, workers=None):
+        """fn over items on `workers` threads (green threads when eventlet is
+        patched in); the buckets keep them together inside the limits."""
+        with ThreadPoolExecutor(max_workers=workers or SHOPIFY_CONCURRENCY) as pool:
+            return list(pool.map(fn, items))
+
+
+shopify_client = ShopifyClient()
+
+
+def graphql(query, variables=None):
+    """Run a query against the store's Admin GraphQL API and return its data."""
+    body = shopify_client.graphql(graphql_url, headers, query, variables)
+    if body.get('errors'):
+        raise ShopifyGraphQLError(body['errors'])
+    return body['data']
+
+
+def user_errors(result):
+    """Raise the userErrors of a mutation result, if it has any."""
+    if result.get('userErrors'):
+        raise ShopifyGraphQLError(result['userErrors'])
+    return result
@@ -0,0 +1,147 @@
+"""Local SKU / barcode -> Shopify product, variant and inventory item index.
+
+    python shopify_index.py refresh     # rebuild from the store
+
+Existence checks before an upload are a single indexed Mongo lookup instead
+of paging through every product in the store. The index is built once from
+the store (250 products per request) and kept current by the uploads
+themselves; run a refresh after products are changed in the Shopify admin.
+"""
+import argparse
+import logging
+from datetime import datetime, timezone
+
+import shopify
+from pymongo import UpdateOne
+
+from logs import configure_logging
+from shopify_client import shopify_client
+from storage import BulkWriter, db
+
+
+logger = logging.getLogger(__name__)
+
+shopify_index_collection = db['shopify_index']
+
+# Products requested per page when rebuilding the index
+REFRESH_PAGE_SIZE = 250
+
+
+def ensure_shopify_index_indexes():
+    # Entries used to be keyed by SKU: the old unique index would reject every size after the first
+    if shopify_index_collection.index_information().get('sku_1', {}).get('unique'):
+        shopify_index_collection.drop_index('sku_1')
+    shopify_index_collection.create_index('variant_id', unique=True)
+    # Most products use one SKU for every size, so SKUs are not unique per variant
+    shopify_index_collection.create_index('sku')
+    shopify_index_collection.create_index('barcode')
+    shopify_index_collection.create_index([('product_id', 1), ('option1', 1)])
+
+
+def gid_id(value):
+    """Numeric ID of a REST ID or a GraphQL gid ("gid://shopify/Product/123")."""
+    return int(str(value).rsplit('/', 1)[-1])
+
+
+def product_gid(product_id):
+    """GraphQL ID of a product, the form stored under the products' shopify.product_id."""
+    return f"gid://shopify/Product/{gid_id(product_id)}"
+
+
+def index_entry(sku, barcode, option1, product_id, variant_id, inventory_item_id):
+    return {
+        'sku': sku.strip(),
+        'barcode': barcode,
+        'option1': option1,
+        'product_id': gid_id(product_id),
+        'variant_id': gid_id(variant_id),
+        'inventory_item_id': gid_id(inventory_item_id) if inventory_item_id else None,
+        'updated_at': datetime.now(timezone.utc),
+    }
+
+
+def save_entries(entries, writer=None):
+    operations = [UpdateOne({'variant_id': entry['variant_id']}, {'$set': entry}, upsert=True)
+                  for entry in entries if entry['sku']]
+    if writer:
+        for operation in operations:
+            writer.add(shopify_index_collection, operation)
+    elif operations:
+        shopify_index_collection.bulk_write(operations, ordered=False)
+
+
+def entries_from_product(product):
+    """Index entries of a shopify.Product resource."""
+    return [index_entry(variant.sku or '', getattr(variant, 'barcode', None), getattr(variant, 'option1', None),
+                        product.id, variant.id, getattr(variant, 'inventory_item_id', None))
+            for variant in product.variants]
+
+
+def record_product(product, writer=None):
+    """Update the index after a product was created or updated through the REST API."""
+    save_entries(entries_from_product(product), writer)
+
+
+def record_bulk_result(product_id, variants, writer=None):
+    """Update the index from a productSet result (see shopify_bulk.shopify_ids)."""
+    save_entries([index_entry(v['sku'] or '', v.get('barcode'), v.get('option1'), product_id, v['id'],
+                              v['inventory_item_id'])
+                  for v in variants], writer)
+
+
+def forget_product(product_id):
+    shopify_index_collection.delete_many({'product_id': gid_id(product_id)})
+
+
+def lookup_sku(sku):
+    return shopify_index_collection.find_one({'sku': sku.strip()})
+
+
+def lookup_variant(product_id, option1):
+    return shopify_index_collection.find_one({'product_id': gid_id(product_id), 'option1': option1})
+
+
+def lookup_barcode(barcode):
+    return shopify_index_collection.find_one({'barcode': barcode})
+
+
+def refresh_index():
+    """Rebuild the index from every product in the store. Returns the number of variants indexed."""
+    started = datetime.now(timezone.utc)
+    count = 0
+    since_id = 0
+    with BulkWriter() as writer:
+        while True:
+            products = shopify_client.rest(shopify.Product.find, since_id=since_id, limit=REFRESH_PAGE_SIZE,
+                                           fields='id,variants')
+            if not products:
+                break
+            for product in products:
+                entries = entries_from_product(product)
+                save_entries(entries, writer)
+                count += len(entries)
+            since_id = products[-1].id
+    # Whatever was not seen in the store any more is gone
+    shopify_index_collection.delete_many({'updated_at': {'$lt': started}})
+    logger.info('Indexed %d Shopify variants', count)
+    return count
+
+
+def ensure_index_built():
+    """Build the index the first time it is needed."""
+    if shopify_index_collection.estimated_document_count() == 0:
+        refresh_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['refresh'])
+    parser.parse_args()
+    configure_logging()
+    import upload_shopify  # noqa: F401 -- sets up the Shopify API session
+    ensure_shopify_index_indexes()
+    refresh_index()
+
+
+if __name__ == '__main__':
+    main()
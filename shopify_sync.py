@@ -0,0 +1,285 @@
+"""Push catalog changes to Shopify, sending only what changed since the last push.
+
+    python shopify_sync.py                  # every product
+    python shopify_sync.py --brand Nike     # one brand
+    python shopify_sync.py --inventory      # stock levels only
+
+Each product's transform_mongo_to_shopify output is hashed in parts (product
+fields, images, each variant, each inventory level) and the hashes are kept
+on the product under `shopify.hashes`. Unchanged products cost no API calls;
+for the rest only the changed fields, variants and inventory levels are sent.
+Products are synced on a pool of workers sharing the client's rate limit.
+
+--inventory only compares each size's Quantity with the quantity last pushed
+and sends the levels that changed, up to INVENTORY_BATCH_SIZE per
+inventorySetQuantities call, using the inventory item IDs in the SKU index.
+Products that were never synced, or have gained a size since, need a full sync.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import shopify
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from logs import configure_logging
+from metrics import timer
+from shopify_client import ShopifyGraphQLError, graphql, shopify_client, user_errors
+from shopify_index import lookup_sku, lookup_variant, product_gid, record_product, shopify_index_collection
+from storage import BulkWriter, products_collection
+from upload_shopify import (get_location_id, product_exists_by_sku, set_inventory, transform_mongo_to_shopify,
+                            update_existing_product, upload_product_to_shopify)
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Inventory levels sent per inventorySetQuantities call (Shopify takes up to 250)
+INVENTORY_BATCH_SIZE = int(os.environ.get('INVENTORY_BATCH_SIZE', 250))
+
+PRODUCT_FIELDS = ('title', 'body_html', 'vendor', 'product_type', 'tags', 'status')
+VARIANT_FIELDS = ('option1', 'sku', 'barcode', 'price', 'inventory_management', 'inventory_policy',
+                  'fulfillment_service', 'requires_shipping')
+
+SYNC_CREATED = 'created'
+SYNC_UPDATED = 'updated'
+SYNC_UNCHANGED = 'unchanged'
+SYNC_FAILED = 'failed'
+
+INVENTORY_SET_MUTATION = """
+mutation inventorySet($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    inventoryAdjustmentGroup { id }
+    userErrors { field message }
+  }
+}
+"""
+
+
+def canonical_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def sync_hashes(product_data):
+    """Hashes of the parts of a transformed product that are updated separately."""
+    return {
+        'product': canonical_hash({field: product_data[field] for field in PRODUCT_FIELDS}),
+        'images': canonical_hash(product_data['images']),
+        # Keyed by size: most products use the same SKU for every size
+        'variants': {
+            variant['option1']: {
+                'hash': canonical_hash({field: variant[field] for field in VARIANT_FIELDS}),
+                'quantity': variant['inventory_quantity'],
+            }
+            for variant in product_data['variants']
+        },
+    }
+
+
+def hashes_document(hashes):
+    # Variants are stored as a list: sizes ("10.5") are not valid field names
+    return dict(hashes, variants=[dict(v, option1=size) for size, v in hashes['variants'].items()])
+
+
+def save_hashes(m_product, hashes, product_id=None):
+    fields = {
+        'shopify.hashes': hashes_document(hashes),
+        'shopify.synced_at': datetime.now(timezone.utc),
+    }
+    if product_id:
+        # Lets the bulk publish update this product instead of creating another
+        fields['shopify.product_id'] = product_gid(product_id)
+    products_collection.update_one({'_id': m_product['_id']}, {'$set': fields})
+
+
+def stored_hashes(m_product):
+    hashes = (m_product.get('shopify') or {}).get('hashes')
+    if not hashes:
+        return None
+    return dict(hashes, variants={v['option1']: {'hash': v['hash'], 'quantity': v['quantity']}
+                                  for v in hashes['variants']})
+
+
+def push_changes(product_data, hashes, previous):
+    """Send only what differs between `previous` and `hashes`. Returns False if
+    the product is not in the SKU index (it has to be uploaded in full)."""
+    first = lookup_sku(product_data['variants'][0]['sku'])
+    if not first:
+        return False
+    product_id = first['product_id']
+
+    changes = {}
+    if hashes['product'] != previous['product']:
+        changes.update({field: product_data[field] for field in PRODUCT_FIELDS})
+    if hashes['images'] != previous['images']:
+        changes['images'] = product_data['images']
+    if changes:
+        shopify_client.rest(shopify.Product(dict(changes, id=product_id)).save)
+
+    for variant in product_data['variants']:
+        size = variant['option1']
+        new, old = hashes['variants'][size], previous['variants'].get(size)
+        if new == old:
+            continue
+        fields = {field: variant[field] for field in VARIANT_FIELDS}
+        entry = lookup_variant(product_id, size)
+        if entry is None:
+            # A size that was not on the product before
+            shopify_client.rest(shopify.Variant(dict(fields, product_id=product_id)).save)
+            record_product(shopify_client.rest(shopify.Product.find, product_id))
+            entry, old = lookup_variant(product_id, size), None
+        elif old is None or old['hash'] != new['hash']:
+            shopify_client.rest(shopify.Variant(dict(fields, id=entry['variant_id'], product_id=product_id)).save)
+        if entry and (old is None or old['quantity'] != new['quantity']):
+            set_inventory(get_location_id(), entry['inventory_item_id'], new['quantity'])
+    return True
+
+
+def sync_product(m_product):
+    """Bring one product up to date on Shopify. Returns one of the SYNC_* outcomes."""
+    try:
+        product_data = transform_mongo_to_shopify(m_product)
+        if not product_data['variants'] or not all(v['sku'] for v in product_data['variants']):
+            logger.warning('Not syncing %s: variants without a SKU', m_product.get('title'))
+            return SYNC_FAILED
+        hashes = sync_hashes(product_data)
+        previous = stored_hashes(m_product)
+        if previous == hashes:
+            return SYNC_UNCHANGED
+
+        if previous is not None and push_changes(product_data, hashes, previous):
+            outcome = SYNC_UPDATED
+        else:
+            # Never synced (or not in the index): full create or update
+            existing_product = product_exists_by_sku(product_data['variants'][0]['sku'])
+            if existing_product:
+                update_existing_product(existing_product, product_data)
+                # Product saves do not carry inventory; set every level once
+                for variant in product_data['variants']:
+                    entry = lookup_variant(existing_product.id, variant['option1'])
+                    if entry and entry['inventory_item_id']:
+                        set_inventory(get_location_id(), entry['inventory_item_id'], variant['inventory_quantity'])
+                outcome = SYNC_UPDATED
+            else:
+                upload_product_to_shopify(m_product)
+                if not lookup_sku(product_data['variants'][0]['sku']):
+                    return SYNC_FAILED
+                outcome = SYNC_CREATED
+    except Exception as e:
+        logger.error('Sync of %s failed: %r', m_product.get('sku'), e)
+        return SYNC_FAILED
+
+    entry = lookup_sku(product_data['variants'][0]['sku'])
+    save_hashes(m_product, hashes, entry and entry['product_id'])
+    return outcome
+
+
+def sync_catalog(query=None, workers=None):
+    """Sync every product matching `query` on a worker pool. Returns outcome counts."""
+    counts = {SYNC_CREATED: 0, SYNC_UPDATED: 0, SYNC_UNCHANGED: 0, SYNC_FAILED: 0}
+    for outcome in shopify_client.map(sync_product, products_collection.find(query or {}), workers):
+        counts[outcome] += 1
+    logger.info('Shopify sync finished', extra=counts)
+    return counts
+
+
+def load_inventory_items():
+    """SKU -> Shopify product ID and (product ID, size) -> inventory item ID, read from the SKU index in one query."""
+    product_ids, items = {}, {}
+    for entry in shopify_index_collection.find({}, {'sku': 1, 'product_id': 1, 'option1': 1, 'inventory_item_id': 1}):
+        product_ids.setdefault(entry['sku'], entry['product_id'])
+        items[(entry['product_id'], entry['option1'])] = entry['inventory_item_id']
+    return product_ids, items
+
+
+def set_quantities(location_id, levels):
+    """Set [(inventory item ID, quantity)] at one location with a single mutation."""
+    with timer('inventory_update', api='graphql'):
+        user_errors(graphql(INVENTORY_SET_MUTATION, {'input': {
+            'name': 'available',
+            'reason': 'correction',
+            'ignoreCompareQuantity': True,
+            'quantities': [{'inventoryItemId': f'gid://shopify/InventoryItem/{item_id}',
+                            'locationId': f'gid://shopify/Location/{location_id}',
+                            'quantity': quantity} for item_id, quantity in levels],
+        }})['inventorySetQuantities'])
+
+
+def sync_inventory(query=None, batch_size=INVENTORY_BATCH_SIZE):
+    """Push the stock levels that changed since the last sync. Returns counts."""
+    counts = {'levels_updated': 0, 'levels_unchanged': 0, 'levels_failed': 0, 'products_needing_full_sync': 0}
+    product_ids, items = load_inventory_items()
+    location_id = get_location_id()
+    stored = {}  # product _id -> its stored variant hashes, quantities updated as they are pushed
+    batch = []   # (product _id, size, inventory item ID, quantity)
+
+    with BulkWriter() as writer:
+        def send():
+            try:
+                set_quantities(location_id, [(item_id, quantity) for _, _, item_id, quantity in batch])
+            except ShopifyGraphQLError as e:
+                logger.error('Inventory update of %d levels failed: %s', len(batch), e)
+                counts['levels_failed'] += len(batch)
+                batch.clear()
+                return
+            touched = set()
+            for _id, size, _, quantity in batch:
+                next(v for v in stored[_id] if v['option1'] == size)['quantity'] = quantity
+                touched.add(_id)
+            for _id in touched:
+                # What full syncs compare against next time
+                writer.add(products_collection, UpdateOne({'_id': _id}, {'$set': {'shopify.hashes.variants': stored[_id]}}))
+            counts['levels_updated'] += len(batch)
+            batch.clear()
+
+        # Only products a sync has pushed have quantities to compare with
+        cursor = products_collection.find(dict(query or {}, **{'shopify.hashes': {'$exists': True}}),
+                                          {'Variants': 1, 'shopify.hashes.variants': 1})
+        for m_product in cursor:
+            variants = m_product.get('Variants') or []
+            pushed = {v['option1']: v for v in m_product['shopify']['hashes']['variants']}
+            product_id = product_ids.get((variants[0].get('SKU') or '').strip()) if variants else None
+            if product_id is None or any(v.get('Size') not in pushed or (product_id, v.get('Size')) not in items
+                                         for v in variants):
+                counts['products_needing_full_sync'] += 1
+                continue
+            for variant in variants:
+                quantity = variant.get('Quantity')
+                if pushed[variant['Size']]['quantity'] == quantity:
+                    counts['levels_unchanged'] += 1
+                    continue
+                if not isinstance(quantity, int):
+                    logger.warning('Not syncing quantity %r of %s size %s', quantity, variant.get('SKU'), variant['Size'])
+                    counts['levels_failed'] += 1
+                    continue
+                stored.setdefault(m_product['_id'], list(pushed.values()))
+                batch.append((m_product['_id'], variant['Size'], items[(product_id, variant['Size'])], quantity))
+                if len(batch) >= batch_size:
+                    send()
+        if batch:
+            send()
+
+    logger.info('Inventory sync finished', extra=counts)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--brand', help='only sync this brand')
+    parser.add_argument('--workers', type=int, help='products synced at the same time')
+    parser.add_argument('--inventory', action='store_true', help='only push changed stock levels')
+    args = parser.parse_args()
+    configure_logging()
+    query = {'brand': args.brand} if args.brand else None
+    if args.inventory:
+        sync_inventory(query)
+    else:
+        sync_catalog(query, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import logging
+import os
+import re
+import time
+
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from dotenv import load_dotenv
+
+from metrics import count, timer
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+mongo_uri = os.environ.get('MONGODB_URI')
+# Connections in the pool shared by every request and scrape in this process
+MONGO_POOL_SIZE = int(os.environ.get('MONGO_POOL_SIZE', 50))
+# serverSelectionTimeoutMS limits how long a call waits for an unreachable server;
+# connect=False defers connecting to the first operation, so importing never waits on Mongo
+client = pymongo.MongoClient(mongo_uri, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_POOL_SIZE, connect=False)
+db = client['admin']  # Database name
+# Every brand lives in this one collection, told apart by the brand field
+products_collection = db['products']
+
+# Flush queued writes once this many are pending...
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 100))
+# ...or once the oldest one has waited this many seconds
+BULK_MAX_DELAY = float(os.environ.get('BULK_MAX_DELAY', 2))
+
+
+def ensure_product_indexes(collection=None):
+    """Indexes behind every product lookup: (brand, sku) is unique so scrape
+    upserts are a single indexed lookup, the rest serve the paginated
+    brand/gender listings and most-recently-updated queries."""
+    collection = collection if collection is not None else products_collection
+    try:
+        collection.create_index([('brand', 1), ('sku', 1)], unique=True)
+    except OperationFailure as e:
+        # Existing duplicate SKUs have to be cleaned up before the index can be built
+        logger.error('Could not create unique brand/sku index on %s: %s', collection.name, e)
+    collection.create_index('sku')
+    # /products pages through a brand (optionally one gender) in _id order
+    collection.create_index([('brand', 1), ('_id', 1)])
+    collection.create_index([('brand', 1), ('gender', 1), ('_id', 1)])
+    collection.create_index([('updated_at', -1)])
+
+
+def product_key(product):
+    return {'brand': product['brand'], 'sku': product['sku']}
+
+
+# Fields the admin product grid renders; Images is cut down to the thumbnail
+GRID_PROJECTION = {
+    'title': 1, 'brand': 1, 'color': 1, 'gender': 1, 'material': 1, 'age_group': 1,
+    'size': 1, 'sku': 1, 'barcode': 1, 'weight': 1, 'quantity': 1, 'price': 1,
+    'Images': {'$slice': 1},
+}
+
+
+def product_filter(brand, gender=None, size=None, min_price=None, max_price=None, after=None, sku=None):
+    """Build the /products query. `after` is the last _id of the previous page."""
+    query = {'brand': brand}
+    if sku:
+        query['sku'] = sku
+    if gender:
+        # Stored genders are inconsistently cased ("Womens footwear" / "Womens Footwear")
+        query['gender'] = {'$regex': f'^{re.escape(gender)}$', '$options': 'i'}
+    if size:
+        query['Variants'] = {'$elemMatch': {'Size': size, 'Quantity': {'$gt': 0}}}
+    if min_price is not None or max_price is not None:
+        # Prices are stored as scraped strings; ones that are not numbers never match
+        price = {'$convert': {'input': '$price', 'to': 'double', 'onError': None, 'onNull': None}}
+        bounds = []
+        if min_price is not None:
+            bounds.append({'$gte': [price, min_price]})
+        if max_price is not None:
+            bounds.append({'$and': [{'$ne': [price, None]}, {'$lte': [price, max_price]}]})
+        query['$expr'] = {'$and': bounds}
+    if after is not None:
+        query['_id'] = {'$gt': after}
+    return query
+
+
+class BulkWriter:
+    """Queues upserts and sends them with unordered bulk_write calls.
+
+    Use it as a context manager so whatever is still queued is flushed when
+    the block exits.
+    """
+
+    def __init__(self, batch_size=BULK_BATCH_SIZE, max_delay=BULK_MAX_DELAY, on_flush=None):
+        self.batch_size = batch_size
+        self.on_flush = on_flush  # called after every flush that wrote something
+        self.max_delay = max_delay
+        self.pending = {}  # collection name -> (collection, [operations])
+        self.count = 0
+        self.oldest = None
+        self.stats = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
+        self.sent = []  # operations of the last flush
+        self.failed = []  # those of them that were rejected
+
+    def upsert(self, collection, key, document):
+        self.add(collection, UpdateOne(key, {'$set': document}, upsert=True))
+
+    def add(self, collection, operation):
+        self.pending.setdefault(collection.full_name, (collection, []))[1].append(operation)
+        self.count += 1
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if self.count >= self.batch_size or time.monotonic() - self.oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        self.count, self.oldest = 0, None
+        sent, failed = [], []
+        for collection, operations in pending.values():
+            sent += operations
+            try:
+                with timer('db_write', collection=collection.name):
+                    result = collection.bulk_write(operations, ordered=False).bulk_api_result
+            except BulkWriteError as e:
+                result = e.details
+                failed += [operations[error['index']] for error in result.get('writeErrors', [])]
+                logger.warning('Bulk write to %s had %d errors', collection.name, len(result.get('writeErrors', [])))
+            written = {
+                'inserted': result.get('nUpserted', 0),
+                'updated': result.get('nModified', 0),
+                'unchanged': result.get('nMatched', 0) - result.get('nModified', 0),
+                'errors': len(result.get('writeErrors', [])),
+            }
+            for outcome, n in written.items():
+                self.stats[outcome] += n
+                if n:
+                    count('db_writes', n, collection=collection.name, result=outcome)
+        self.sent, self.failed = sent, failed
+        if pending and self.on_flush:
+            self.on_flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
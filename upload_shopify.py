@@ -1,88 +1,102 @@
+import logging
 import shopify
-import pymongo
-from pymongo.errors import ConnectionFailure
-import time
-import base64
 import requests
 from dotenv import load_dotenv
 import os
+import threading
+import time
+import pyactiveresource.connection
+from pyactiveresource.connection import ResourceNotFound
+
+from images import IMAGE_STORE, shopify_image_src
+from metrics import timer
+from shopify_client import ACCESS_TOKEN, ShopifyGraphQLError, headers, shop_admin_url, shopify_client
+from shopify_index import ensure_index_built, forget_product, lookup_sku, record_product
+
 
+logger = logging.getLogger(__name__)
 
 load_dotenv()
-ACCESS_TOKEN = os.environ.get('ACCESS_TOKEN')
-mongo_uri = os.environ.get('MONGODB_URI')
-# MongoDB Configuration
-try:
-    # client = pymongo.MongoClient('mongodb://localhost:27017/', serverSelectionTimeoutMS=5000)
-    client = pymongo.MongoClient('mongo_uri')
-
-    # The serverSelectionTimeoutMS option limits the amount of time the connection attempt will wait for a response
-    db = client['admin']  # Database name
-    collectionA = db['adidas']  # Collection name
-    collectionB = db['nike']
-    collectionC = db['jordan']
-    # Check if the server is available
-    client.admin.command('ping')
-    print("MongoDB connection successful!")
-    
-except ConnectionFailure as e:
-    print(f"MongoDB connection failed: {e}")
-
-# Create session with Access Token for authentication
-shop_url = f"https://revamped-retail-boutique.myshopify.com/admin/api/2023-10"
-headers = {
-    "X-Shopify-Access-Token": ACCESS_TOKEN
-}
+# Inventory location; without it the store's first location is looked up on first use
+SHOPIFY_LOCATION_ID = os.environ.get('SHOPIFY_LOCATION_ID')
+# Seconds a REST call to Shopify may take, so an unreachable store fails fast
+SHOPIFY_TIMEOUT = float(os.environ.get('SHOPIFY_TIMEOUT', 15))
+# Seconds before a failed location lookup is tried again
+LOCATION_RETRY_AFTER = float(os.environ.get('LOCATION_RETRY_AFTER', 30))
+
+# Create session with Access Token for authentication (no request is made here)
+shop_url = f"{shop_admin_url}/api/2023-10"
 shopify.ShopifyResource.set_site(shop_url)
+# ShopifyResource.headers is per thread, copied from _headers the first time a
+# thread (or green thread) uses it: the token has to be in _headers to reach
+# the upload pool's threads and the app's request handlers
+shopify.ShopifyResource._headers.update(headers)
 shopify.ShopifyResource.headers.update(headers)
+shopify.ShopifyResource.timeout = SHOPIFY_TIMEOUT
 
-# Step 1: Get the location ID where the inventory will be updated
-locations = shopify.Location.find()
-location_id = None
-
-# We assume there's only one location. If there are multiple, you need to choose the right one
-if locations:
-    location_id = locations[0].id  # Get the first location ID
-
-if location_id:
-    print(f"Location ID: {location_id}")
-else:
-    print("No location found. Please ensure you have set up inventory locations in your Shopify store.")
-    exit()
-
-# Function to read the image and encode it for Shopify
-def encode_image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-        return encoded_string
-# Function to check if a product with the same SKU already exists
-def product_exists_by_sku(sku):
-    since_id = None
-    while True:
-        if since_id:
-            products = shopify.Product.find(since_id=since_id)
-        else:
-            products = shopify.Product.find()
 
-        if not products:
-            break  # Exit if no more products are found
+class ShopifyUnavailable(Exception):
+    pass
 
-        for product in products:
-            for variant in product.variants:
-                if variant.sku and variant.sku.strip() == sku.strip():  # Check if SKU is not None
-                    return product
 
-        since_id = products[-1].id  # Update since_id to the last product's ID
+_location = {'id': int(SHOPIFY_LOCATION_ID) if SHOPIFY_LOCATION_ID else None, 'error': None, 'failed_at': 0.0}
+_location_lock = threading.Lock()
 
-    return None
 
+# Get the location ID where the inventory will be updated. It is looked up once
+# and cached; a failed lookup is remembered for LOCATION_RETRY_AFTER seconds
+def get_location_id():
+    with _location_lock:
+        if _location['id']:
+            return _location['id']
+        if _location['error'] and time.monotonic() - _location['failed_at'] < LOCATION_RETRY_AFTER:
+            raise ShopifyUnavailable(_location['error'])
+        if not ACCESS_TOKEN:
+            raise ShopifyUnavailable("ACCESS_TOKEN is not set")
+        try:
+            locations = shopify_client.rest(shopify.Location.find)
+        except (pyactiveresource.connection.UnauthorizedAccess, pyactiveresource.connection.ForbiddenAccess) as e:
+            locations, error = None, f"Shopify rejected the access token: {e.code} {e.response.msg}"
+        except (pyactiveresource.connection.Error, OSError) as e:
+            locations, error = None, f"Shopify is not reachable: {e}"
+        else:
+            error = "No location found. Please ensure you have set up inventory locations in your Shopify store."
+        # We assume there's only one location. If there are multiple, you need to choose the right one
+        if not locations:
+            _location.update(error=error, failed_at=time.monotonic())
+            logger.error(error)
+            raise ShopifyUnavailable(error)
+        _location.update(id=locations[0].id, error=None)
+        logger.info('Shopify location ID: %s', _location['id'])
+        return _location['id']
+
+
+def shopify_status():
+    """Whether Shopify can be used, for the readiness check."""
+    try:
+        return {"ok": True, "location_id": get_location_id()}
+    except ShopifyUnavailable as e:
+        return {"ok": False, "error": str(e)}
+
+# Function to check if a product with the same SKU already exists
+# The SKU is looked up in the local index (see shopify_index.py); only a hit
+# costs one API call, to load the product that is about to be updated
+def product_exists_by_sku(sku):
+    ensure_index_built()
+    entry = lookup_sku(sku)
+    if not entry:
+        return None
+    try:
+        return shopify_client.rest(shopify.Product.find, entry['product_id'])
+    except ResourceNotFound:
+        # Deleted in the Shopify admin since it was indexed
+        forget_product(entry['product_id'])
+        return None
 
 
-adidas_products = collectionA.find()
-nike_products = collectionB.find()
-jordan_products = collectionC.find()
 
-def transform_mongo_to_shopify(mongo_data):
+def transform_mongo_to_shopify(mongo_data, upload_images=True):
+    # upload_images=False leaves out local images that are not on Shopify yet instead of uploading them
     # Convert "product_detail" to "body_html" with <ul> and <li> tags
     product_detail_lines = mongo_data['product_detail'].split('\n')
     body_html = "<ul>" + "".join([f"<li>{line.strip()}</li>" for line in product_detail_lines]) + "</ul>"
@@ -90,18 +104,22 @@ def transform_mongo_to_shopify(mongo_data):
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
     # Construct the full path to the "static/uploads" folder based on the script's location
-    uploads_dir = os.path.join(script_dir, 'static', 'uploads')
+    uploads_dir = os.path.join(script_dir, IMAGE_STORE)
     # Transform Images
     images = []
     for img_url in mongo_data['Images']:
         if img_url.startswith("/uploads"):  # Local image
-            # Encode the image for uploading to Shopify
+            # Local images reach Shopify through a staged upload (once per distinct image)
             local_image_path = os.path.join(uploads_dir, os.path.basename(img_url))  # Assuming the image is in a relative uploads folder
             if os.path.exists(local_image_path):
-                encoded_image = encode_image_to_base64(local_image_path)
-                images.append({"attachment": encoded_image})
+                try:
+                    src = shopify_image_src(local_image_path, upload=upload_images)
+                    if src:
+                        images.append({"src": src})
+                except (requests.exceptions.RequestException, ShopifyGraphQLError) as e:
+                    logger.warning('Could not upload local image %s: %s', local_image_path, e)
             else:
-                print(f"Local image not found: {local_image_path}")
+                logger.warning('Local image not found: %s', local_image_path)
         else:
             # Use the URL as-is for Shopify
             images.append({"src": img_url})
@@ -171,42 +189,44 @@ def update_existing_product(existing_product, new_product_data):
     existing_product.images = new_product_data['images']
 
     # Save updated product
-    existing_product.save()
+    shopify_client.rest(existing_product.save)
+    record_product(existing_product)
     return existing_product
 
-# Retry function for inventory updates
-def set_inventory_with_retry(location_id, inventory_item_id, quantity, retries=5, delay=2):
-    """Set inventory level with retry logic and exponential backoff."""
-    for attempt in range(retries):
-        try:
-            inventory_level = shopify.InventoryLevel.set(location_id, inventory_item_id, quantity)
-            print(f"Successfully updated variant with {quantity} units at location {location_id}")
-            return inventory_level  # Exit if successful
-        except Exception as e:
-            print(f"Attempt {attempt + 1} failed: {e}. Retrying...")
-            time.sleep(delay * (2 ** attempt))  # Exponential backoff
-    print(f"Failed to update inventory after {retries} attempts.")
+# Inventory updates go through the rate-limited client, which waits for room
+# in Shopify's call bucket and only retries on an actual 429
+def set_inventory(location_id, inventory_item_id, quantity):
+    if not isinstance(quantity, int):
+        # An unknown stock count leaves Shopify's level as it is
+        logger.warning('Not setting unknown quantity %r', quantity, extra={'inventory_item_id': inventory_item_id})
+        return None
+    with timer('inventory_update', api='rest'):
+        inventory_level = shopify_client.rest(shopify.InventoryLevel.set, location_id, inventory_item_id, quantity)
+    logger.debug('Set inventory to %s', quantity, extra={'inventory_item_id': inventory_item_id,
+                                                          'location_id': location_id})
+    return inventory_level
 
 # Main process to upload or update products
 def upload_product_to_shopify(m_product):
     
-    product_data = transform_mongo_to_shopify(adidas_products[0])
-    print(f"Checking SKU: {product_data['variants'][0]['sku']}")
+    product_data = transform_mongo_to_shopify(m_product)
     # Check if the product already exists by SKU
     existing_product = product_exists_by_sku(product_data['variants'][0]['sku'])  # Use SKU of first variant
 
     if existing_product:
-        print(f"Product with SKU {product_data['variants'][0]['sku']} already exists with ID: {existing_product.id}")
         # Update the existing product with new data
         updated_product = update_existing_product(existing_product, product_data)
-        print(f"Product '{updated_product.title}' updated successfully.")
+        logger.info('Updated Shopify product %s', updated_product.id,
+                    extra={'sku': product_data['variants'][0]['sku'], 'title': updated_product.title})
     else:
         # Create a new product if it doesn't exist
-        new_product = shopify.Product.create(product_data) 
+        new_product = shopify_client.rest(shopify.Product.create, product_data)
         if new_product.errors:
-            print(f"Error creating product {product_data['title']}: {new_product.errors.full_messages()}")
+            logger.error('Could not create product %s: %s', product_data['title'], new_product.errors.full_messages())
         else:
-            print(f"Product '{new_product.title}' created successfully with ID: {new_product.id}")
+            logger.info('Created Shopify product %s', new_product.id,
+                        extra={'sku': product_data['variants'][0]['sku'], 'title': new_product.title})
+            record_product(new_product)
 
             # Step 3: Update inventory for each variant
             for variant in new_product.variants:
@@ -216,5 +236,10 @@ def upload_product_to_shopify(m_product):
                         quantity = variant_data['inventory_quantity']
                         break
 
-                # Update inventory level at the specific location with retry logic
-                set_inventory_with_retry(location_id, inventory_item_id, quantity)
\ No newline at end of file
+                # Update inventory level at the specific location
+                set_inventory(get_location_id(), inventory_item_id, quantity)
+
+
+def upload_products_to_shopify(m_products, workers=None):
+    """Upload several products at once; the shared client keeps them inside the API limit."""
+    return shopify_client.map(upload_product_to_shopify, m_products, workers)
@@ -0,0 +1,23 @@
+import eventlet
+eventlet.monkey_patch()  # make requests/pymongo sockets cooperative so jobs can run concurrently
+
+from jobs import ensure_job_indexes, run_worker, socket_emitter
+from logs import configure_logging
+from metrics import METRICS_PORT, serve as serve_metrics
+from revisits import REVISIT_BRANDS, ensure_revisit_indexes, run_scheduler
+from scraper import ensure_validator_index
+
+
+# Runs queued scrape jobs outside the web process (see the worker entry in the Procfile)
+if __name__ == '__main__':
+    configure_logging()
+    if METRICS_PORT:
+        # The worker has no web server of its own; Prometheus scrapes it here
+        serve_metrics(METRICS_PORT)
+    ensure_job_indexes()
+    ensure_validator_index()
+    if REVISIT_BRANDS:
+        # Products of these brands are also revisited on their own schedule, between jobs
+        ensure_revisit_indexes()
+        eventlet.spawn(run_scheduler)
+    run_worker(emit=socket_emitter())